@@ -0,0 +1,452 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# Author: Graham.Williams@microsoft.com
+#
+# A command line script to measure the speed of classify, detect and
+# the webcam conversions, writing the results as JSON to compare across
+# commits.
+#
+# ml benchmark cvbp [--model=<name>] [--output=<file>] [--compare=<file>] [<path> ...]
+# ml benchmark cvbp --startup [--budget=<seconds>]
+#
+# From the Microsoft Best Practices Suite: Computer Vision
+# https://github.com/microsoft/ComputerVision
+
+# ----------------------------------------------------------------------
+# Setup.
+# ----------------------------------------------------------------------
+
+# Required libraries.
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import subprocess
+
+from catalogue import all_models, backends
+
+# ----------------------------------------------------------------------
+# Parse command line arguments: path --model= --backend= --batch-sizes=
+# --workers= --threads= --procs= --sizes= --images= --repeat= --output= --compare=
+# --startup --budget=
+# ----------------------------------------------------------------------
+
+def numbers(text):
+    return [int(n) for n in text.split(",") if n]
+
+
+options = argparse.ArgumentParser(
+    prog='benchmark',
+    description='Measure the speed of the models and image conversions.'
+)
+
+options.add_argument(
+    'path',
+    nargs="*",
+    help='images to measure with (default is a generated set)')
+
+options.add_argument(
+    '-m', '--model',
+    help="classifier to measure (default is all)")
+
+options.add_argument(
+    '--backend',
+    choices=backends,
+    default="eager",
+    help="run the classifiers eagerly or compiled (default is eager)")
+
+options.add_argument(
+    '--batch-sizes',
+    type=numbers,
+    default=[1, 8],
+    help="comma separated batch sizes to measure (default is 1,8)")
+
+options.add_argument(
+    '--workers',
+    type=numbers,
+    default=[0, 4],
+    help="comma separated decoding threads to measure (default is 0,4)")
+
+options.add_argument(
+    '--threads',
+    type=numbers,
+    default=sorted({1, os.cpu_count() or 1}),
+    help="comma separated torch threads to measure (default is 1 and all)")
+
+options.add_argument(
+    '--procs',
+    type=numbers,
+    default=sorted({1, os.cpu_count() or 1}),
+    help="comma separated worker processes to measure (default is 1 and all)")
+
+options.add_argument(
+    '--sizes',
+    type=numbers,
+    default=[200, 480, 800],
+    help="comma separated detector input sizes (default is 200,480,800)")
+
+options.add_argument(
+    '--images',
+    type=int,
+    default=32,
+    help="number of images to generate when none are given (default is 32)")
+
+options.add_argument(
+    '--repeat',
+    type=int,
+    default=3,
+    help="passes over the images for each measurement (default is 3)")
+
+options.add_argument(
+    '--startup',
+    action='store_true',
+    help="only measure how long the light commands take to start")
+
+options.add_argument(
+    '--budget',
+    type=float,
+    default=1.0,
+    help="seconds each light command may take to start (default is 1.0)")
+
+options.add_argument(
+    '-o', '--output',
+    help="file to write the JSON results to (default is stdout)")
+
+options.add_argument(
+    '--compare',
+    help="earlier JSON results to report the changes against")
+
+args = options.parse_args()
+
+if args.model is None or args.model == "all":
+    modeln = list(all_models)
+elif args.model in all_models:
+    modeln = [args.model]
+else:
+    sys.stderr.write(f"Selected model '{args.model}' is not known.\n")
+    sys.exit(1)
+
+if min(args.batch_sizes + args.threads + args.procs + args.sizes +
+       [args.images, args.repeat]) < 1 \
+   or min(args.workers) < 0:
+    sys.stderr.write("The sizes, threads and counts must be positive.\n")
+    sys.exit(1)
+
+previous = None
+if args.compare is not None:
+    try:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    except (OSError, ValueError) as e:
+        sys.stderr.write(f"Cannot read the results in '{args.compare}': {e}\n")
+        sys.exit(1)
+
+# ----------------------------------------------------------------------
+# Measurement helpers
+# ----------------------------------------------------------------------
+
+def sample_images(count):
+    """Generate a fixed set of JPEG images, the same on every run.
+
+    Half are landscape and half portrait so that both shapes pass
+    through the conversions and the detector.
+
+    :return: The paths of the images.
+    """
+    folder = utils.cache_dir("benchmark")
+    rng = np.random.RandomState(0)
+    paths = []
+    for i in range(count):
+        path = os.path.join(folder, f"sample{i:03d}.jpg")
+        height, width = (480, 640) if i % 2 == 0 else (640, 480)
+        if not os.path.exists(path):
+            noise = rng.randint(0, 256, (height // 8, width // 8, 3), dtype=np.uint8)
+            cv.imwrite(path, cv.resize(noise, (width, height), interpolation=cv.INTER_CUBIC))
+        paths.append(path)
+    return paths
+
+
+def peak_rss():
+    """Return the largest resident memory of the process so far in MB."""
+    kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return kb / 1024 if sys.platform != "darwin" else kb / 1024 / 1024
+
+
+def summary(times, items=None):
+    """Return the latency percentiles and throughput of a measurement.
+
+    :param times: The seconds taken by each call.
+    :param items: The number of images processed, if not one per call.
+    """
+    times = sorted(times)
+    def at(q):
+        return round(1000 * times[min(len(times) - 1, int(q * len(times)))], 3)
+    total = sum(times)
+    return {
+        "images_per_sec": round((items or len(times)) / total, 2) if total else None,
+        "p50_ms": at(0.50),
+        "p95_ms": at(0.95),
+        "p99_ms": at(0.99),
+    }
+
+
+def timed(func, *args):
+    """Call func, returning its result and the seconds it took."""
+    start = time.perf_counter()
+    out = func(*args)
+    return out, time.perf_counter() - start
+
+
+results = []
+
+def record(bench, params, metrics):
+    """Add a measurement to the results, noting it on stderr."""
+    results.append({"bench": bench, **params, **metrics,
+                    "peak_rss_mb": round(peak_rss(), 1)})
+    shown = ",".join(f"{k}={v}" for k, v in params.items())
+    sys.stderr.write(f"{bench},{shown}: {metrics}\n")
+
+
+def git_commit():
+    """Return the commit of the package being measured, if known."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+METRICS = ["images_per_sec", "p50_ms", "p95_ms", "p99_ms",
+           "speedup", "load_s", "startup_s", "peak_rss_mb"]
+
+def key(result):
+    return tuple((k, v) for k, v in result.items() if k not in METRICS)
+
+
+def finish(images=0):
+    """Write the results as JSON, and compare them with earlier ones.
+    """
+    torch = sys.modules.get("torch")
+    report = {
+        "commit": git_commit(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "torch": torch.__version__ if torch is not None else None,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "images": images,
+        "repeat": args.repeat,
+        "peak_rss_mb": round(peak_rss(), 1),
+        "results": results,
+    }
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    elif previous is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if previous is None:
+        return
+    before = {key(r): r for r in previous.get("results", [])}
+    print("bench,params,metric,before,after,change")
+    for r in results:
+        if key(r) not in before:
+            continue
+        params = ";".join(f"{k}={v}" for k, v in key(r)[1:])
+        for metric in METRICS:
+            old, new = before[key(r)].get(metric), r.get(metric)
+            if old is None or new is None:
+                continue
+            change = f"{100 * (new - old) / old:+.1f}%" if old else ""
+            print(f"{r['bench']},{params},{metric},{old},{new},{change}")
+
+# ----------------------------------------------------------------------
+# Startup of the commands that should not load the heavy libraries
+# ----------------------------------------------------------------------
+
+# Each is run in a fresh interpreter, with no server to forward to, and
+# the fastest of the repeats is taken.
+
+startup = {
+    "classify --model=list": ["classify.py", "--model=list"],
+    "detect --model=list": ["detect.py", "--model=list"],
+    "detect --help": ["detect.py", "--help"],
+    "benchmark --help": ["benchmark.py", "--help"],
+    "import client": ["-c", "import client"],
+    "import utils": ["-c", "import utils"],
+}
+
+if args.startup:
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, CVBP_SERVER=os.path.join(here, "no-server.sock"))
+    slow = []
+    for name, command in startup.items():
+        times = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            done = subprocess.run([sys.executable] + command, cwd=here, env=env,
+                                  stdout=subprocess.DEVNULL)
+            times.append(time.perf_counter() - start)
+        if done.returncode != 0:
+            sys.stderr.write(f"'{name}' failed to run.\n")
+            sys.exit(1)
+        record("startup", {"command": name}, {"startup_s": round(min(times), 3)})
+        if min(times) > args.budget:
+            slow.append(name)
+
+    finish()
+    for name in slow:
+        sys.stderr.write(f"'{name}' took longer than {args.budget}s to start.\n")
+    sys.exit(1 if slow else 0)
+
+# ----------------------------------------------------------------------
+# Load the libraries for the remaining measurements
+# ----------------------------------------------------------------------
+
+import utils
+
+import cv2 as cv
+import numpy as np
+import torch
+
+from fastai.vision import open_image
+from PIL import Image
+
+from utils_cv.detection.data import coco_labels
+from utils_cv.detection.model import DetectionLearner
+
+from fetch import locate
+from zoo import get_model, clear_models, build_detector
+from zoo import prepare_image, prepare_frame, image_batch, predict_batch, detect_batch
+
+# ----------------------------------------------------------------------
+# The images to measure with
+# ----------------------------------------------------------------------
+
+if len(args.path):
+    paths = [imfile for _, imfile in map(locate, args.path) if imfile is not None]
+else:
+    paths = sample_images(args.images)
+
+frames = [cv.imread(p) for p in paths]
+paths = [p for p, f in zip(paths, frames) if f is not None]
+frames = [f for f in frames if f is not None]
+if not len(paths):
+    sys.stderr.write("None of the paths are images that can be measured.\n")
+    sys.exit(1)
+
+# ----------------------------------------------------------------------
+# Decoding, over the number of worker threads
+# ----------------------------------------------------------------------
+
+def decode(path):
+    return timed(lambda: prepare_image(open_image(path, convert_mode='RGB')))
+
+
+for workers in args.workers:
+    times, start = [], time.perf_counter()
+    for _ in range(args.repeat):
+        times += [t for _, t in utils.prefetch(decode, paths, workers)]
+    wall = time.perf_counter() - start
+    stats = summary(times)
+    stats["images_per_sec"] = round(len(times) / wall, 2)  # Across workers.
+    record("decode", {"workers": workers}, stats)
+
+xs = [prepare_image(open_image(p, convert_mode='RGB')) for p in paths]
+
+# ----------------------------------------------------------------------
+# Webcam frame conversion, allocating and into a reused buffer
+# ----------------------------------------------------------------------
+
+for reuse in [False, True]:
+    out = utils.frame_buffer(xs[0].shape[1], xs[0].shape[2]) if reuse else None
+    times = [timed(prepare_frame, f, out)[1]
+             for _ in range(args.repeat) for f in frames]
+    record("cv2torch", {"reuse": reuse}, summary(times))
+
+# ----------------------------------------------------------------------
+# Classifying across processes, as with --procs
+# ----------------------------------------------------------------------
+
+def classify_chunk(paths):
+    """Decode and classify a chunk of images in a worker process."""
+    xs = [prepare_image(open_image(p, convert_mode='RGB')) for p in paths]
+    predict_batch(get_model(modeln[0], args.backend), image_batch(xs))
+    return len(xs)
+
+
+get_model(modeln[0], args.backend)  # Shared with the workers.
+size = max(args.batch_sizes)
+single = None
+for procs in args.procs:
+    start = time.perf_counter()
+    items = sum(sum(utils.fork_map(classify_chunk, utils.batched(paths, size), procs))
+                for _ in range(args.repeat))
+    rate = items / (time.perf_counter() - start)
+    single = rate if procs == 1 else single
+    record("procs",
+           {"model": modeln[0], "backend": args.backend,
+            "batch_size": size, "procs": procs},
+           {"images_per_sec": round(rate, 2),
+            "speedup": round(rate / single, 2) if single else None})
+clear_models()
+
+# ----------------------------------------------------------------------
+# Classifiers, over the batch sizes and torch threads
+# ----------------------------------------------------------------------
+
+for m in modeln:
+    model, seconds = timed(get_model, m, args.backend)
+    record("load", {"model": m, "backend": args.backend},
+           {"load_s": round(seconds, 3)})
+
+    for threads in args.threads:
+        torch.set_num_threads(threads)
+        for size in args.batch_sizes:
+            batches = [image_batch(b) for b in utils.batched(xs, size)]
+            predict_batch(model, batches[0])  # Warm up.
+            times = [timed(predict_batch, model, xb)[1]
+                     for _ in range(args.repeat) for xb in batches]
+            record("classify",
+                   {"model": m, "backend": args.backend,
+                    "batch_size": size, "threads": threads},
+                   summary(times, args.repeat * len(xs)))
+    clear_models()
+    del model
+
+# ----------------------------------------------------------------------
+# Faster R-CNN, over the input sizes and torch threads
+# ----------------------------------------------------------------------
+
+ims = [Image.open(p).convert("RGB") for p in paths]
+
+for size in args.sizes:
+    model, seconds = timed(build_detector, "fasterrcnn_resnet50_fpn", "balanced",
+                           min_size=size, max_size=size)
+    record("load", {"model": "fasterrcnn_resnet50_fpn", "size": size},
+           {"load_s": round(seconds, 3)})
+    detector = DetectionLearner(model=model, labels=coco_labels()[1:])
+
+    for threads in args.threads:
+        torch.set_num_threads(threads)
+        detect_batch(detector, ims[:1])  # Warm up.
+        times = [timed(detect_batch, detector, [im])[1]
+                 for _ in range(args.repeat) for im in ims]
+        record("detect",
+               {"model": "fasterrcnn_resnet50_fpn", "size": size, "threads": threads},
+               summary(times))
+
+# ----------------------------------------------------------------------
+# Write the results, and compare them with earlier ones
+# ----------------------------------------------------------------------
+
+finish(len(paths))
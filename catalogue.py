@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# Author: Graham.Williams@microsoft.com
+#
+# The names of the pre-built models, detection profiles and backends.
+#
+# Only the standard library is used here so that the commands can list
+# the models and parse their arguments before loading torch.
+#
+# From the Microsoft Best Practices Suite: Computer Vision
+# https://github.com/microsoft/ComputerVision
+
+all_models = [
+        "alexnet",
+        "densenet121",
+        "densenet161",
+        "densenet169",
+        "densenet201",
+        "resnet101",
+        "resnet152",
+        "resnet18",
+        "resnet34",
+        "resnet50",
+        "squeezenet1_0",
+        "squeezenet1_1",
+        "vgg16_bn",
+        "vgg19_bn",
+    ]
+
+# The pre-built object detection models, the lighter MobileNetV3
+# backbones being much faster on CPU at some cost in accuracy.
+
+detectors = [
+        "fasterrcnn_resnet50_fpn",
+        "fasterrcnn_mobilenet_v3_large_fpn",
+        "fasterrcnn_mobilenet_v3_large_320_fpn",
+    ]
+
+# Speed and accuracy profiles for the detectors. The input is scaled so
+# its shorter side is min_size unless the longer would exceed max_size.
+# The region proposal network keeps the best rpn_pre_nms_top_n_test
+# proposals, and rpn_post_nms_top_n_test after its NMS, for the box
+# head to classify. Boxes scoring under box_score_thresh are dropped,
+# those overlapping more than box_nms_thresh are merged, and at most
+# box_detections_per_img are kept. realtime is what detect has always
+# used, which misses small objects.
+
+profiles = {
+    "realtime": dict(
+        min_size=200, max_size=200,
+        rpn_pre_nms_top_n_test=5, rpn_post_nms_top_n_test=5,
+        box_score_thresh=0.05, box_nms_thresh=0.5, box_detections_per_img=100),
+    "balanced": dict(
+        min_size=480, max_size=800,
+        rpn_pre_nms_top_n_test=300, rpn_post_nms_top_n_test=100,
+        box_score_thresh=0.05, box_nms_thresh=0.5, box_detections_per_img=50),
+    "accurate": dict(
+        min_size=800, max_size=1333,
+        rpn_pre_nms_top_n_test=1000, rpn_post_nms_top_n_test=1000,
+        box_score_thresh=0.05, box_nms_thresh=0.5, box_detections_per_img=100),
+}
+
+# The backends the classifiers can run on, eagerly through fastai or
+# compiled. See zoo.compile_model().
+
+backends = ["eager", "torchscript", "onnx", "int8"]
@@ -15,44 +15,18 @@
 # Setup.
 # ----------------------------------------------------------------------
 
-# Required libraries.
+import timing
+import client
 
-import utils
+# Required libraries.
 
-import os
 import sys
+import time
 import argparse
-import tempfile
-import urllib.request
-
-from mlhub.pkg import is_url
-from mlhub.utils import get_cmd_cwd
-
-from functools import partial
-
-from fastai.vision import models, open_image, Image
-
-from utils_cv.classification.data import imagenet_labels
-from utils_cv.classification.model import IMAGENET_IM_SIZE, model_to_learner
-
-all_models = [
-        "densenet201",
-        "alexnet",
-        "densenet121",
-        "densenet161",
-        "densenet169",
-        "densenet201",
-        "resnet101",
-        "resnet152",
-        "resnet18",
-        "resnet34",
-        "resnet50",
-        "squeezenet1_0",
-        "squeezenet1_1",
-        "vgg16_bn",
-        "vgg19_bn",
-    ]
 
+from catalogue import all_models, backends
+from ensemble import methods
+from writers import formats
 
 # ----------------------------------------------------------------------
 # Parse command line arguments: path --model= --webcam=
@@ -63,7 +37,36 @@ options = argparse.ArgumentParser(add_help=False)
 options.add_argument(
     'path',
     nargs="*",
-    help='path or url to image')
+    help='path, url, directory or quoted glob of images or videos')
+
+options.add_argument(
+    '--manifest',
+    help="file listing further paths or urls, one per line, - for stdin")
+
+options.add_argument(
+    '--shard',
+    help="classify only shard i of N, as i/N counting from 0")
+
+options.add_argument(
+    '-o', '--output',
+    help="write to this file, resuming where an earlier run stopped")
+
+options.add_argument(
+    '--format',
+    choices=formats,
+    default="csv",
+    help="write the results as csv, jsonl, parquet or sqlite (default is csv)")
+
+options.add_argument(
+    '--top-k',
+    type=int,
+    default=1,
+    help="write the k most likely classes of each image (default is 1)")
+
+options.add_argument(
+    '--timings',
+    action='store_true',
+    help="also write the milliseconds each model took per image")
 
 options.add_argument(
     '-m', '--model',
@@ -73,9 +76,78 @@ options.add_argument(
     '-w', '--webcam',
     help="which webcam to use (default is 0)")
 
+options.add_argument(
+    '--backend',
+    choices=backends,
+    default="eager",
+    help="run the models eagerly or compiled (default is eager)")
+
+options.add_argument(
+    '--max-models',
+    type=int,
+    help="most models to keep loaded at once (default is all)")
+
+options.add_argument(
+    '--ensemble',
+    action='append',
+    choices=methods,
+    help="also combine the models' classes by mean or vote (may be repeated)")
+
+options.add_argument(
+    '--concurrent',
+    type=int,
+    default=1,
+    help="models to run at once on each batch (default is 1)")
+
+options.add_argument(
+    '-b', '--batch-size',
+    type=int,
+    default=1,
+    help="number of images per forward pass (default is 1)")
+
+options.add_argument(
+    '--fetchers',
+    type=int,
+    default=8,
+    help="concurrent downloads of image urls (default is 8)")
+
+options.add_argument(
+    '--workers',
+    type=int,
+    default=0,
+    help="threads to decode images ahead of the model (default is 0)")
+
+options.add_argument(
+    '--no-cache',
+    action='store_true',
+    help="neither reuse nor store results in the result cache")
+
+options.add_argument(
+    '--refresh',
+    action='store_true',
+    help="classify again, replacing results in the result cache")
+
+options.add_argument(
+    '--procs',
+    type=int,
+    default=1,
+    help="worker processes to share the cores between (default is 1)")
+
+options.add_argument(
+    '--every',
+    type=int,
+    default=1,
+    help="classify every Nth frame of a video (default is 1)")
+
+options.add_argument(
+    '--fps',
+    type=float,
+    help="instead classify this many frames per second of video")
+
 args = options.parse_args()
 
 webcam = 0 if args.webcam is None else args.webcam
+listed = len(args.path) or args.manifest is not None
 
 if args.model == "list":
     for m in all_models: print(m)
@@ -84,133 +156,321 @@ elif args.model == None:
     modeln = ["resnet152"]
 elif args.model == "all":
     modeln = all_models
-    if not len(args.path):
+    if not listed:
         sys.stderr.write("Cannot utilise all models from the webcam. " +
                          "Do not choose --model=all.\n")
         sys.exit(1)
 else:
     modeln = [args.model]
-    
+
+for m in modeln:
+    if m not in all_models:
+        sys.stderr.write(f"Selected model '{m}' is not known.\n")
+        sys.exit(1)
+
+if args.top_k < 1:
+    sys.stderr.write("The number of classes to write must be at least 1.\n")
+    sys.exit(1)
+
+if args.format in ("parquet", "sqlite") and args.output is None:
+    sys.stderr.write(f"Writing {args.format} needs a file to write to, with --output.\n")
+    sys.exit(1)
+
+if args.max_models is not None and args.max_models < 1:
+    sys.stderr.write("The number of models to keep must be at least 1.\n")
+    sys.exit(1)
+
+if args.concurrent < 1:
+    sys.stderr.write("The number of models to run at once must be at least 1.\n")
+    sys.exit(1)
+
+# No more models run at once than may be kept loaded.
+
+concurrent = min(args.concurrent, args.max_models or args.concurrent, len(modeln))
+
+if args.batch_size < 1:
+    sys.stderr.write("The batch size must be at least 1.\n")
+    sys.exit(1)
+
+if args.workers < 0 or args.fetchers < 0:
+    sys.stderr.write("The number of workers can not be negative.\n")
+    sys.exit(1)
+
+if args.procs < 1:
+    sys.stderr.write("The number of processes must be at least 1.\n")
+    sys.exit(1)
+
+if args.every < 1 or args.fps is not None and args.fps <= 0:
+    sys.stderr.write("The video frames to sample must be positive.\n")
+    sys.exit(1)
+
+# Forward to `ml serve cvbp` when it is running, before loading
+# anything heavy.
+
+if client.forward("classify", options, args, modeln):
+    raise SystemExit(0)
+
+# ----------------------------------------------------------------------
+# Load the libraries and labels, only now the arguments are known good
+# ----------------------------------------------------------------------
+
+import utils
+import corpus
+import writers
+
+from fetch import locate, release, released
+
+from functools import partial
+from itertools import tee
+
+from fastai.vision import open_image
+
+from utils_cv.classification.model import IMAGENET_IM_SIZE
+
+from results import ResultCache, TOP_K, digest, top_classes
+from zoo import get_model, cache_learners, imagenet_classes, fingerprint, ensure_compiled
+from zoo import prepare_image, prepare_frame, image_batch, predict_batch
+
+timing.record("import", timing.started)
+
+if args.max_models is not None:
+    cache_learners(args.max_models)
+
+try:
+    shard = corpus.parse_shard(args.shard)
+except ValueError as e:
+    sys.stderr.write(f"{e}\n")
+    sys.exit(1)
+
 try:
-    labels = imagenet_labels()   # The 1000 labels.
+    labels = imagenet_classes()   # The 1000 labels.
 except:
     sys.stderr.write("Failed to obtain labels probably because of " +
                      "a network connection error.\n")
     sys.exit(1)
 
+# Images already classified by a model are answered from the result
+# cache, by the content of the image and the model's fingerprint.
+
+# A compiled model is identified by its file, so is compiled first.
+
+store = None if args.no_cache else ResultCache(refresh=args.refresh)
+if args.backend != "eager":
+    for m in modeln:
+        ensure_compiled(m, args.backend)
+keys = {m: fingerprint(m, backend=args.backend) for m in modeln}
+
+# At least TOP_K classes are kept for each image, more for --top-k, and
+# cached results with fewer are classified again.
+
+top_k = max(TOP_K, args.top_k)
+wanted = min(args.top_k, len(labels))
+
+# The columns written, videos adding the frame and its time.
+
+columns = [
+    ("score", "float", ".2f"),
+    ("label", "str", ""),
+    ("model", "str", ""),
+    ("rank", "int", None),
+    ("ms", "float", ".1f"),
+    ("frame", "int", ""),
+    ("seconds", "float", ".3f"),
+    ("path", "str", ""),
+]
+if not args.timings:
+    columns = [c for c in columns if c[0] != "ms"]
+
 # ----------------------------------------------------------------------
-# Load the pre-built model
+# Read the images, with urls fetched through the download cache
 # ----------------------------------------------------------------------
 
-for path in args.path:
+def load_image(item):
+    """Read and resize an image in a worker, keeping its path with it.
+
+    Videos are passed through to be read frame by frame. Images whose
+    results are all in the cache are not read.
+
+    :return: The path, the image tensor, the hash of the image and the
+             results found in the cache by model.
+    """
+    path, imfile = item
+    if imfile is None or utils.is_video(path):
+        return path, imfile, None, {}
 
-    if is_url(path):
-        tempdir = tempfile.gettempdir()
-        imfile = os.path.join(tempdir, "temp.jpg")
-        urllib.request.urlretrieve(path, imfile)
-    else:
-        imfile = os.path.join(get_cmd_cwd(), path)
-    
     try:
-        im = open_image(imfile, convert_mode='RGB')
+        key, found = None, {}
+        if store is not None:
+            key = digest(imfile)
+            found = {m: top for m, top in store.get_many(key, keys).items()
+                     if len(top) >= wanted}
+            if len(found) == len(keys):
+                return path, None, key, found
+        with timing.stage("decode"):
+            im = open_image(imfile, convert_mode='RGB')
     except:
         sys.stderr.write(f"'{imfile}' may not be an image file and will be skipped.\n")
-        continue
-
-    # Select the pre-built model.
-
-    for m in modeln: 
-        if m == "densenet201":
-            model = model_to_learner(models.densenet201(pretrained=True), IMAGENET_IM_SIZE)
-        elif m == "resnet152":
-            model = model_to_learner(models.resnet152(pretrained=True), IMAGENET_IM_SIZE)
-        elif m == "alexnet":
-            model = model_to_learner(models.alexnet(pretrained=True), IMAGENET_IM_SIZE)
-        elif m == "densenet121":
-            model = model_to_learner(models.densenet121(pretrained=True), IMAGENET_IM_SIZE)
-        elif m == "densenet161":
-            model = model_to_learner(models.densenet161(pretrained=True), IMAGENET_IM_SIZE)
-        elif m == "densenet169":
-            model = model_to_learner(models.densenet169(pretrained=True), IMAGENET_IM_SIZE)
-        elif m == "densenet201":
-            model = model_to_learner(models.densenet201(pretrained=True), IMAGENET_IM_SIZE)
-        elif m == "resnet101":
-            model = model_to_learner(models.resnet101(pretrained=True), IMAGENET_IM_SIZE)
-        elif m == "resnet152":
-            model = model_to_learner(models.resnet152(pretrained=True), IMAGENET_IM_SIZE)
-        elif m == "resnet18":
-            model = model_to_learner(models.resnet18(pretrained=True), IMAGENET_IM_SIZE)
-        elif m == "resnet34":
-            model = model_to_learner(models.resnet34(pretrained=True), IMAGENET_IM_SIZE)
-        elif m == "resnet50":
-            model = model_to_learner(models.resnet50(pretrained=True), IMAGENET_IM_SIZE)
-        elif m == "squeezenet1_0":
-            model = model_to_learner(models.squeezenet1_0(pretrained=True), IMAGENET_IM_SIZE)
-        elif m == "squeezenet1_1":
-            model = model_to_learner(models.squeezenet1_1(pretrained=True), IMAGENET_IM_SIZE)
-        elif m == "vgg16_bn":
-            model = model_to_learner(models.vgg16_bn(pretrained=True), IMAGENET_IM_SIZE)
-        elif m == "vgg19_bn":
-            model = model_to_learner(models.vgg19_bn(pretrained=True), IMAGENET_IM_SIZE)
-        else:
-            sys.stderr.write(f"Selected model '{m}' is not known.\n")
-            sys.exit(1)
-        # model = model_to_learner(models.BasicBlock(pretrained=True), IMAGENET_IM_SIZE) # unexpected keyword argument 'pretrained'
-        # model = model_to_learner(models.Darknet(pretrained=True), IMAGENET_IM_SIZE) # unexpected keyword argument 'pretrained'
-        # model = model_to_learner(models.DynamicUnet(pretrained=True), IMAGENET_IM_SIZE) # missing 2 required positional arguments: 'encoder' and 'n_classes'
-        # model = model_to_learner(models.ResLayer(pretrained=True), IMAGENET_IM_SIZE) # unexpected keyword argument 'pretrained'
-        # model = model_to_learner(models.ResNet(pretrained=True), IMAGENET_IM_SIZE) # unexpected keyword argument 'pretrained'
-        # model = model_to_learner(models.SqueezeNet(pretrained=True), IMAGENET_IM_SIZE) # unexpected keyword argument 'pretrained'
-        # model = model_to_learner(models.UnetBlock(pretrained=True), IMAGENET_IM_SIZE) # missing 3 required positional arguments: 'up_in_c', 'x_in_c', and 'hook'
-        # model = model_to_learner(models.WideResNet(pretrained=True), IMAGENET_IM_SIZE) # unexpected keyword argument 'pretrained'
-        # model = model_to_learner(models.XResNet(pretrained=True), IMAGENET_IM_SIZE) # unexpected keyword argument 'pretrained'
-        # model = model_to_learner(models.darknet(pretrained=True), IMAGENET_IM_SIZE) # 'module' object is not callable
-        # model = model_to_learner(models.unet(pretrained=True), IMAGENET_IM_SIZE) # 'module' object is not callable
-        # model = model_to_learner(models.wrn(pretrained=True), IMAGENET_IM_SIZE) # 'module' object is not callable
-        # model = model_to_learner(models.wrn_22(pretrained=True), IMAGENET_IM_SIZE) # got an unexpected keyword argument 'pretrained'
-        # model = model_to_learner(models.xception(pretrained=True), IMAGENET_IM_SIZE) # got an unexpected keyword argument 'pretrained'
-        # model = model_to_learner(models.xresnet(pretrained=True), IMAGENET_IM_SIZE) #  'module' object is not callable
-        # model = model_to_learner(models.xresnet101(pretrained=True), IMAGENET_IM_SIZE) # name 'model_urls' is not defined
-        # model = model_to_learner(models.xresnet152(pretrained=True), IMAGENET_IM_SIZE) # name 'model_urls' is not defined
-        # model = model_to_learner(models.xresnet18(pretrained=True), IMAGENET_IM_SIZE) # name 'model_urls' is not defined
-        # model = model_to_learner(models.xresnet34(pretrained=True), IMAGENET_IM_SIZE) # name 'model_urls' is not defined
-        # model = model_to_learner(models.xresnet50(pretrained=True), IMAGENET_IM_SIZE) # name 'model_urls' is not defined
-
-        # Predict the class label.
-
-        _, ind, prob = model.predict(im)
-        sys.stdout.write(f"{prob[ind]:.2f},{labels[ind]},{m},{path}\n")
-
-# TODO: Want to load from local copy rather than from ~/.torch which
-# means that for a new model the model first needs to be
-# downloaded. We might want to cache this downoad in CONFIGURE.
-# Some attempts:
-
-# model = load_learner(file="resnet18-5c106cde.pth")
-# trdat = untar_data("resnet18-5c106cde.pth")
-# model = load_learner(trdat)
+        return path, None, None, {}
+    finally:
+        release(imfile)
+    return path, prepare_image(im), key, found
+
+
+def load_frames(images):
+    """Expand videos into their sampled frames, passing images through.
+
+    :return: A generator of (path, frame, x, key, found) where frame is
+             the (index, seconds) of a video frame or None for an image.
+    """
+    for path, x, key, found in images:
+        if not isinstance(x, str):
+            if x is not None or found:
+                yield path, None, x, key, found
+            continue
+
+        try:
+            for index, seconds, frame in utils.video_frames(x, args.every, args.fps):
+                yield path, (index, seconds), prepare_frame(frame, normalise=False), None, {}
+        except OSError as e:
+            sys.stderr.write(f"{e} It will be skipped.\n")
+
+# ----------------------------------------------------------------------
+# Classify the images, loading each pre-built model only once
+# ----------------------------------------------------------------------
+
+# Paths are streamed from the directories, globs and manifest, skipping
+# those in other shards and those an earlier run has already written.
+
+writer = writers.open_writer(args.format, args.output, columns)
+
+paths = (p for p in corpus.expand(args.path, args.manifest)
+         if corpus.in_shard(p, shard) and p not in writer.done)
+
+
+def classify_batch(n, batch):
+    """Classify the n'th batch with each model, unless cached.
+
+    Video frames are reported by their index and time in seconds.
+
+    :return: The path and the rows for each item in the batch.
+    """
+
+    # Alternate the order the models are visited in from batch to batch
+    # so that with --max-models the most recently used are reused first.
+
+    order = modeln if n % 2 == 0 else modeln[::-1]
+
+    # The images each model has no cached result for are normalised into
+    # one tensor, shared by all the models needing the same images.
+
+    needs, shared = {}, {}
+    for m in order:
+        needs[m] = tuple(i for i, item in enumerate(batch) if m not in item[4])
+        if len(needs[m]) and needs[m] not in shared:
+            shared[needs[m]] = image_batch([batch[i][2] for i in needs[m]])
+
+    def run(m):
+        if not len(needs[m]):
+            return (), 0.0
+        start = time.perf_counter()
+        probs = predict_batch(get_model(m, args.backend), shared[needs[m]])
+        return probs, 1000 * (time.perf_counter() - start) / len(needs[m])
+
+    # Cached results took no time.
+
+    took = {}
+    workers = concurrent if concurrent > 1 else 0  # One model runs inline.
+    for m, (probs, ms) in zip(order, utils.prefetch(run, order, workers)):
+        for i, prob in zip(needs[m], probs):
+            _, _, _, key, found = batch[i]
+            found[m] = top_classes(prob, top_k)
+            took[i, m] = ms
+            if store is not None and key is not None:
+                store.put(key, keys[m], found[m])
+
+    results = []
+    with timing.stage("output"):
+        for i, (path, frame, _, _, found) in enumerate(batch):
+            where = dict(path=path)
+            if frame is not None:
+                where.update(frame=frame[0], seconds=frame[1])
+            rows = []
+            for m in modeln:
+                for rank, (prob, ind) in enumerate(found[m][:args.top_k], 1):
+                    rows.append(dict(score=prob, label=labels[ind], model=m, rank=rank,
+                                     ms=took.get((i, m), 0.0), **where))
+            # An ensemble takes the time of all of its models.
+
+            ms = sum(took.get((i, m), 0.0) for m in modeln)
+            for method in args.ensemble or []:
+                prob, ind = methods[method]([found[m][:TOP_K] for m in modeln])
+                rows.append(dict(score=prob, label=labels[ind], model=f"ensemble-{method}",
+                                 rank=1, ms=ms, **where))
+            results.append((path, rows))
+    return results
+
+
+def classify_paths(chunk):
+    """Read and classify the n'th chunk of fetched paths in a worker process.
+    """
+    n, files = chunk
+    inputs = load_frames(map(load_image, files))
+    return [result for batch in utils.batched(inputs, args.batch_size)
+            for result in classify_batch(n, batch)]
+
+
+if args.procs > 1:
+
+    # The models are loaded before the workers are forked so that they
+    # share them. Each worker reads and classifies a chunk of paths,
+    # fetched here so that only this process evicts from the cache.
+
+    for m in modeln:
+        get_model(m, args.backend)
+    files = utils.prefetch(locate, paths, args.fetchers)
+    chunks, sent = tee(utils.batched(files, args.batch_size))
+    results = released(utils.fork_map(classify_paths, enumerate(chunks), args.procs), sent)
+
+else:
+    files = utils.prefetch(locate, paths, args.fetchers)
+    images = utils.prefetch(load_image, files, args.workers,
+                            depth=2 * max(args.workers, args.batch_size))
+
+    # Video frames are decoded in the background while the model runs.
+
+    inputs = utils.background(load_frames(images), depth=2 * args.batch_size)
+    results = (classify_batch(n, batch)
+               for n, batch in enumerate(utils.batched(inputs, args.batch_size)))
+
+for batch in results:
+    for path, rows in batch:
+        writer.write(path, rows)
+
+writer.close()
 
 # ------------------------------------------------------------------------
 # If no args then use the webcam
 # ------------------------------------------------------------------------
 
-if not len(args.path):
+if not listed:
 
     # ----------------------------------------------------------------------
     # Prepare processing function
     # ----------------------------------------------------------------------
 
-    def classify_frame(capture, model, label):
+    def classify_frame(frame, model, label, buffer):
         """Use the model to predict the class label.
         """
-        _, frame = capture.read()  # Capture frame-by-frame
-        _, ind, prob = model.predict(Image(utils.cv2torch(frame)))
+        prob = predict_batch(model, prepare_frame(frame, buffer)[None])[0]
+        ind = prob.argmax()
         utils.put_text(frame, f"{label[ind]} ({prob[ind]:.2f})")
         return utils.cv2matplotlib(frame)
 
-    # Can allow utilise one model for webcam.
-    
-    func = partial(classify_frame, model=model, label=labels)
+    # Can allow utilise one model for webcam. Each frame is converted
+    # into the same buffer.
+
+    func = partial(classify_frame, model=get_model(modeln[0], args.backend), label=labels,
+                   buffer=utils.frame_buffer(IMAGENET_IM_SIZE, IMAGENET_IM_SIZE))
 
     # ----------------------------------------------------------------------
     # Run webcam to show processed results
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# Author: Graham.Williams@microsoft.com
+#
+# Forward classify and detect commands to a running `ml serve cvbp`.
+#
+# This module is imported before anything heavy so that, when a server
+# is running, a command costs little more than starting Python.
+#
+# From the Microsoft Best Practices Suite: Computer Vision
+# https://github.com/microsoft/ComputerVision
+
+import http.client
+import json
+import os
+import socket
+import sys
+
+
+def endpoint():
+    """Return where the server listens.
+
+    This is CVBP_SERVER, either an http://host:port url or the path of a
+    Unix socket, defaulting to server.sock in the package cache.
+    """
+    default = os.path.join(
+        os.environ.get("CVBP_CACHE",
+                       os.path.join(os.path.expanduser("~"), ".cache", "cvbp")),
+        "server.sock")
+    return os.environ.get("CVBP_SERVER", default)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """An HTTP connection over a Unix socket.
+    """
+
+    def __init__(self, path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+def connect(timeout=None):
+    """Return a connection to the server, or None if none is listening.
+    """
+    where = endpoint()
+    if where.startswith("http://"):
+        conn = http.client.HTTPConnection(where[len("http://"):], timeout=timeout)
+    elif os.path.exists(where):
+        conn = UnixHTTPConnection(where, timeout=timeout)
+    else:
+        return None
+
+    try:
+        conn.connect()
+    except OSError:
+        return None
+    return conn
+
+
+def request(task, paths, models=None, fmt="csv", names=None):
+    """Send paths to the server, returning the response body.
+
+    :param task: Either classify or detect.
+    :param paths: The urls or absolute paths of the images.
+    :param models: The names of the models to use, or None for the
+                   server's default.
+    :param fmt: The format of the results, csv or json.
+    :param names: The names to report the images by (default is paths).
+    :return: The body of the response, or None if there is no server.
+    """
+    conn = connect()
+    if conn is None:
+        return None
+
+    body = json.dumps({"paths": paths, "names": names,
+                       "models": models, "format": fmt})
+    conn.request("POST", f"/{task}", body=body,
+                 headers={"Content-Type": "application/json"})
+    response = conn.getresponse()
+    data = response.read()
+    conn.close()
+    if response.status != 200:
+        raise OSError(data.decode("utf-8", "replace").strip())
+    return data
+
+
+def status():
+    """Return the models the server has loaded, from GET /health.
+    """
+    conn = connect()
+    if conn is None:
+        return None
+    conn.request("GET", "/health")
+    response = conn.getresponse()
+    data = response.read()
+    conn.close()
+    return json.loads(data) if response.status == 200 else None
+
+
+def forward(task, options, args, models=None):
+    """Run a command on the server if one is running.
+
+    Only the image paths and, for classify, the models are sent, so any
+    other option given runs the command locally rather than have the
+    server ignore it. A classify command runs on the server only if it
+    has every model loaded for the same backend, and a detect command
+    only if it has the same detector and profile. The webcam,
+    directories, globs, videos and --model=list are always handled
+    locally.
+
+    :param task: Either classify or detect.
+    :param options: The command's argument parser.
+    :param args: The command's parsed arguments.
+    :param models: For classify, the models the command would run.
+    :return: True if the server handled the command.
+    """
+    sent = {"path", "model", "backend"} if task == "classify" else {"path"}
+    if any(value != options.get_default(name)
+           for name, value in vars(args).items() if name not in sent):
+        return False
+
+    if not len(args.path) or args.model == "list":
+        return False
+
+    # Only files and urls are sent. Videos are read locally, frame by
+    # frame.
+
+    from mlhub.pkg import is_url
+    from mlhub.utils import get_cmd_cwd
+    from utils import is_video
+
+    paths = [p if is_url(p) else os.path.join(get_cmd_cwd(), p) for p in args.path]
+    if any(not is_url(p) and not os.path.isfile(p) or is_video(p) for p in paths):
+        return False
+
+    try:
+        health = status()
+        if health is None:
+            return False
+        if task == "classify" and (health.get("backend") != args.backend or
+                                   not set(models) <= set(health.get("classify", []))):
+            return False
+        if task == "detect" and health.get("detector") != [args.model, args.profile]:
+            return False
+        data = request(task, paths, models, names=args.path)
+    except (OSError, http.client.HTTPException, ValueError) as e:
+        sys.stderr.write(f"The server failed ({e}), running locally.\n")
+        return False
+    if data is None:
+        return False
+
+    sys.stdout.write(data.decode("utf-8"))
+    return True
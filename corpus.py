@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# Author: Graham.Williams@microsoft.com
+#
+# Stream the paths of a large collection of images from directories,
+# globs and manifests, split it into shards across processes or
+# machines, and checkpoint the results so an interrupted run resumes
+# where it left off.
+#
+# From the Microsoft Best Practices Suite: Computer Vision
+# https://github.com/microsoft/ComputerVision
+
+import glob
+import os
+import sys
+import zlib
+
+from mlhub.pkg import is_url
+from mlhub.utils import get_cmd_cwd
+
+from utils import VIDEO_EXTENSIONS
+
+IMAGE_EXTENSIONS = {".bmp", ".gif", ".jpeg", ".jpg", ".png", ".tif", ".tiff", ".webp"}
+
+
+def _wanted(name):
+    return os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS | VIDEO_EXTENSIONS
+
+
+def _relative(path, base, given):
+    """Report paths found under a relative argument relative to the cwd."""
+    return path if os.path.isabs(given) else os.path.relpath(path, base)
+
+
+def walk(path):
+    """Yield the images and videos under a directory, in a fixed order.
+    """
+    base = get_cmd_cwd()
+    for root, dirs, files in os.walk(os.path.join(base, path)):
+        dirs.sort()
+        for name in sorted(files):
+            if _wanted(name):
+                yield _relative(os.path.join(root, name), base, path)
+
+
+def read_manifest(manifest):
+    """Yield the paths or urls listed one per line in a manifest.
+
+    Blank lines and lines starting with # are ignored. A manifest of -
+    is read from stdin.
+    """
+    f = sys.stdin if manifest == "-" else open(os.path.join(get_cmd_cwd(), manifest))
+    with f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                yield line
+
+
+def expand(paths, manifest=None):
+    """Yield the images named by paths, directories, globs and a manifest.
+
+    Directories are searched recursively for images and videos, and
+    globs may use ** to match any depth. Quoting a glob keeps it from
+    the shell's argument limit. Nothing is listed ahead of its use.
+
+    :param paths: The paths, urls, directories or globs.
+    :param manifest: A file listing further paths, or - for stdin.
+    :return: A generator of the paths and urls.
+    """
+    base = get_cmd_cwd()
+    for path in paths:
+        if is_url(path):
+            yield path
+        elif os.path.isdir(os.path.join(base, path)):
+            yield from walk(path)
+        elif glob.has_magic(path):
+            for found in glob.iglob(os.path.join(base, path), recursive=True):
+                if os.path.isfile(found):
+                    yield _relative(found, base, path)
+        else:
+            yield path
+    if manifest is not None:
+        yield from read_manifest(manifest)
+
+
+def parse_shard(text):
+    """Parse a shard given as i/N, numbered from 0.
+
+    :return: The (index, count), or None if text is None.
+    """
+    if text is None:
+        return None
+    try:
+        index, count = map(int, text.split("/"))
+    except ValueError:
+        raise ValueError(f"The shard '{text}' is not of the form i/N.")
+    if not 0 <= index < count:
+        raise ValueError(f"The shard {index} is not between 0 and {count - 1}.")
+    return index, count
+
+
+def in_shard(path, shard):
+    """Whether a path falls in a shard.
+
+    Paths are assigned by a hash of their name, so every process given
+    the same corpus agrees on the split whatever order it is listed in.
+
+    :param shard: The (index, count) from parse_shard(), or None.
+    """
+    if shard is None:
+        return True
+    index, count = shard
+    return zlib.crc32(path.encode("utf-8")) % count == index
+
+
+class Checkpoint:
+    """Write results to a file incrementally, remembering completed paths.
+
+    Beside the results a .done file records each completed path with
+    the size of the results once it was written. On resuming, the
+    results are cut back to the last completed path, dropping the part
+    written for a path that was interrupted, and the completed paths
+    are skipped. Results without a .done file are started afresh.
+    """
+
+    def __init__(self, path):
+        path = os.path.join(get_cmd_cwd(), path)
+        self.done_path = path + ".done"
+        self.done = set()
+        offset = 0
+        if os.path.exists(self.done_path):
+            with open(self.done_path) as f:
+                for line in f:
+                    if not line.endswith("\n"):
+                        break  # Cut short by the interruption.
+                    size, _, done = line[:-1].partition("\t")
+                    self.done.add(done)
+                    offset = int(size)
+
+        self.out = open(path, "a+")
+        self.out.truncate(min(offset, self.out.seek(0, os.SEEK_END)))
+        self.out.seek(0, os.SEEK_END)
+        self.log = open(self.done_path, "a")
+        self.current = None
+
+    def write(self, path, text):
+        """Write the results of an image, or a frame of a video.
+
+        A path is taken as complete when the results of another follow.
+        """
+        if path != self.current:
+            self.complete()
+            self.current = path
+        self.out.write(text)
+
+    def complete(self):
+        if self.current is None:
+            return
+        self.out.flush()
+        self.log.write(f"{self.out.tell()}\t{self.current}\n")
+        self.log.flush()
+        self.current = None
+
+    def close(self):
+        self.complete()
+        self.out.close()
+        self.log.close()
@@ -11,6 +11,8 @@
 # From the Microsoft Best Practices Suite: Computer Vision
 # https://github.com/microsoft/ComputerVision
 
+import timing
+
 from mlhub.pkg import mlask, mlcat
 
 mlcat("Microsoft Computer Vision Best Practice", """\
@@ -27,20 +29,22 @@ MLHub package.
 # Setup
 # ----------------------------------------------------------------------
 
-from fastai.vision import models, Image
 from functools import partial
-from torchvision.models.detection import fasterrcnn_resnet50_fpn
 
 # Until this is pip installable we use a local copy!
-from utils_cv.classification.data import imagenet_labels
-from utils_cv.classification.model import IMAGENET_IM_SIZE, model_to_learner
+from utils_cv.classification.model import IMAGENET_IM_SIZE
 from utils_cv.detection.data import coco_labels
 from utils_cv.detection.model import _get_det_bboxes
-from utils_cv.detection.plot import PlotSettings, plot_boxes
 
 import argparse
 import utils
 
+from zoo import get_learner, build_detector, imagenet_classes
+from zoo import prepare_frame, predict_batch
+from tracking import Tracker, draw_tracks
+
+timing.record("import", timing.started)
+
 # ----------------------------------------------------------------------
 # Parse command line arguments
 # ----------------------------------------------------------------------
@@ -75,22 +79,24 @@ To continue close the webcam window with Ctrl-W.
 
 # Webcam classification
 
-def classify_frame(capture, learner, label):
+def classify_frame(frame, learner, label, buffer):
     """Use the learner to predict the class label.
     """
-    _, frame = capture.read()  # Capture frame-by-frame
-    _, ind, prob = learner.predict(Image(utils.cv2torch(frame)))
-    utils.put_text(frame, f"{label[ind]} ({prob[ind]:.2f})")
-    return utils.cv2matplotlib(frame)
+    prob = predict_batch(learner, prepare_frame(frame, buffer)[None])[0]
+    ind = prob.argmax()
+    with timing.stage("output"):
+        utils.put_text(frame, f"{label[ind]} ({prob[ind]:.2f})")
+        return utils.cv2matplotlib(frame)
 
 
-labels = imagenet_labels()  # Load model labels
+labels = imagenet_classes()  # Load model labels
 
 # Load ResNet model
 
-learn = model_to_learner(models.resnet18(pretrained=True), IMAGENET_IM_SIZE)
+learn = get_learner("resnet18")
 
-func = partial(classify_frame, learner=learn, label=labels)
+func = partial(classify_frame, learner=learn, label=labels,
+               buffer=utils.frame_buffer(IMAGENET_IM_SIZE, IMAGENET_IM_SIZE))
 
 # ----------------------------------------------------------------------
 # Run webcam to show processed results
@@ -104,34 +110,41 @@ mlask(end="\n")
 
 mlcat("Webcam Object Detection","""\
 This demonstration will turn on your webcam (if it is accessible) and
-begin identifying objects within the fram of the webcam.
+begin identifying objects within the fram of the webcam. The detector
+runs on every 10th frame, or when the scene changes, and each object is
+followed between with its own number.
 
 To continue close the webcam window with Ctrl-W.
 """)
 
-def detect_frame(capture, model, label):
-    """Use the learner to detect objects.
+def detect_objects(frame, model, label, threshold=0.5):
+    """Use the model to detect objects on a keyframe.
+            """
+    with timing.stage("preprocess"):
+        x = utils.cv2torch(frame)
+    with timing.forward():
+        preds = model([x])
+    with timing.stage("output"):
+        return [(b.score, b.label_name, b.left, b.top, b.right, b.bottom)
+                for b in _get_det_bboxes(preds, labels=label) if b.score > threshold]
+
+
+def detect_frame(frame, tracker):
+    """Detect or follow the objects and draw them on the frame.
             """
-    _, frame = capture.read()  # Capture frame-by-frame
-    preds = model([utils.cv2torch(frame)])
-    anno_bboxes = _get_det_bboxes(preds, labels=label)
-    im_pil = utils.cv2pil(frame)
-    plot_boxes(im_pil, anno_bboxes, plot_settings=PlotSettings(rect_color=(0, 255, 0)))
-    return utils.pil2matplotlib(im_pil)
+    tracks = tracker(frame)
+    with timing.stage("output"):
+        return utils.cv2matplotlib(draw_tracks(frame, tracks))
 
 
 labels = coco_labels()  # Load model labels
-model = fasterrcnn_resnet50_fpn(  # Load ResNet model
-    pretrained=True,
-    rpn_pre_nms_top_n_test=5,
-    rpn_post_nms_top_n_test=5,
-    max_size=200,
-)
+model = build_detector("fasterrcnn_resnet50_fpn", "realtime")  # Load ResNet model
 model.eval()  # Set model to evaluation mode
-func = partial(detect_frame, model=model, label=labels)
+tracker = Tracker(partial(detect_objects, model=model, label=labels), every=10)
+func = partial(detect_frame, tracker=tracker)
 
 # ----------------------------------------------------------------------
 # Run webcam to show processed results
 # ----------------------------------------------------------------------
 
-utils.process_webcam(func, webcam)
+utils.process_webcam(func, webcam, rates={"keyframes": tracker.keyframes})
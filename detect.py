@@ -6,7 +6,7 @@
 #
 # A command line script to detect objects from 90 known objects.
 #
-# ml detect cvbp [<path>]
+# ml detect cvbp [<path>] [--track] [--tile=800]
 #
 # From the Microsoft Best Practices Suite: Computer Vision
 # https://github.com/microsoft/ComputerVision
@@ -15,28 +15,20 @@
 # Setup.
 # ----------------------------------------------------------------------
 
-# Required libraries.
+import timing
+import client
 
-import utils
+# Required libraries.
 
-import os
 import sys
+import time
 import argparse
 
-from mlhub.pkg import is_url
-from mlhub.utils import get_cmd_cwd
-
-from functools import partial
-from PIL import Image
-
-import torchvision
-
-from utils_cv.detection.data import coco_labels
-from utils_cv.detection.model import DetectionLearner
-from utils_cv.detection.plot import plot_boxes, PlotSettings
+from catalogue import detectors, profiles
+from writers import formats
 
 # ----------------------------------------------------------------------
-# Parse command line arguments: path --model= # --webcam=
+# Parse command line arguments: path --model= --webcam= --track
 # ----------------------------------------------------------------------
 
 options = argparse.ArgumentParser(
@@ -46,93 +38,659 @@ options = argparse.ArgumentParser(
 
 options.add_argument(
     'path',
-    nargs="+",
-    help='path or url to image')
+    nargs="*",
+    help='path, url, directory or quoted glob of images or videos')
+
+options.add_argument(
+    '--manifest',
+    help="file listing further paths or urls, one per line, - for stdin")
+
+options.add_argument(
+    '--shard',
+    help="detect only in shard i of N, as i/N counting from 0")
+
+options.add_argument(
+    '-o', '--output',
+    help="write to this file, resuming where an earlier run stopped")
+
+options.add_argument(
+    '--format',
+    choices=formats,
+    default="csv",
+    help="write the results as csv, jsonl, parquet or sqlite (default is csv)")
+
+options.add_argument(
+    '--top-k',
+    type=int,
+    help="write at most the k best objects of each image (default is all)")
+
+options.add_argument(
+    '--timings',
+    action='store_true',
+    help="also write the milliseconds the detector took per image")
+
+options.add_argument(
+    '-b', '--batch-size',
+    type=int,
+    default=1,
+    help="most images of a similar shape per forward pass (default is 1)")
+
+options.add_argument(
+    '--fetchers',
+    type=int,
+    default=8,
+    help="concurrent downloads of image urls (default is 8)")
+
+options.add_argument(
+    '--workers',
+    type=int,
+    default=0,
+    help="threads to decode images ahead of the model (default is 0)")
 
-# options.add_argument(
-#     '-m', '--model',
-#     help="model to use (default is resnet50)")
+options.add_argument(
+    '-m', '--model',
+    default="fasterrcnn_resnet50_fpn",
+    help="model to use, or list (default is fasterrcnn_resnet50_fpn)")
 
-# options.add_argument(
-#     '-w', '--webcam',
-#     help="which webcam to use (default is 0)")
+options.add_argument(
+    '--profile',
+    choices=profiles,
+    default="realtime",
+    help="trade speed for accuracy (default is realtime)")
+
+options.add_argument(
+    '--threshold',
+    type=float,
+    default=0.5,
+    help="lowest score of the objects to report (default is 0.5)")
+
+options.add_argument(
+    '--evaluate',
+    action='store_true',
+    help="report the latency and mAP of each profile on the images")
+
+options.add_argument(
+    '--tile',
+    type=int,
+    help="detect in overlapping square tiles of this many pixels, for large images")
+
+options.add_argument(
+    '--stride',
+    type=int,
+    help="with --tile, the pixels from one tile to the next (default is 3/4 of the tile)")
+
+options.add_argument(
+    '--tile-batch',
+    type=int,
+    default=4,
+    help="with --tile, number of tiles per forward pass (default is 4)")
+
+options.add_argument(
+    '-w', '--webcam',
+    help="which webcam to use (default is 0)")
+
+options.add_argument(
+    '--track',
+    action='store_true',
+    help="detect only on keyframes of videos, following the objects between")
+
+options.add_argument(
+    '--keyframes',
+    type=int,
+    default=10,
+    help="with --track, detect on every Nth frame or a new scene (default is 10)")
+
+options.add_argument(
+    '--every',
+    type=int,
+    default=1,
+    help="detect objects in every Nth frame of a video (default is 1)")
+
+options.add_argument(
+    '--fps',
+    type=float,
+    help="instead detect in this many frames per second of video")
+
+options.add_argument(
+    '--no-cache',
+    action='store_true',
+    help="neither reuse nor store results in the result cache")
+
+options.add_argument(
+    '--refresh',
+    action='store_true',
+    help="detect again, replacing results in the result cache")
+
+options.add_argument(
+    '--procs',
+    type=int,
+    default=1,
+    help="worker processes to share the cores between (default is 1)")
 
 args = options.parse_args()
 
-# webcam = 0 if args.webcam is None else args.webcam
+if args.model == "list":
+    for m in detectors: print(m)
+    sys.exit(0)
+elif args.model not in detectors:
+    sys.stderr.write(f"Selected model '{args.model}' is not known.\n")
+    sys.exit(1)
+
+listed = len(args.path) or args.manifest is not None
+
+if not listed and args.evaluate:
+    sys.stderr.write("Please supply the images to evaluate the profiles on.\n")
+    sys.exit(1)
+
+if args.top_k is not None and args.top_k < 1:
+    sys.stderr.write("The number of objects to write must be at least 1.\n")
+    sys.exit(1)
+
+if args.format in ("parquet", "sqlite") and args.output is None and not args.evaluate:
+    sys.stderr.write(f"Writing {args.format} needs a file to write to, with --output.\n")
+    sys.exit(1)
+
+if args.tile is not None and args.tile < 32:
+    sys.stderr.write("The tiles must be at least 32 pixels.\n")
+    sys.exit(1)
+
+if args.stride is not None and (args.tile is None or not 0 < args.stride <= args.tile):
+    sys.stderr.write("The stride needs --tile and must be between 1 and the tile size.\n")
+    sys.exit(1)
+
+if args.keyframes < 1:
+    sys.stderr.write("The keyframes must be at least 1 frame apart.\n")
+    sys.exit(1)
+
+if args.batch_size < 1 or args.tile_batch < 1:
+    sys.stderr.write("The batch size must be at least 1.\n")
+    sys.exit(1)
+
+if args.workers < 0 or args.fetchers < 0:
+    sys.stderr.write("The number of workers can not be negative.\n")
+    sys.exit(1)
+
+if args.procs < 1:
+    sys.stderr.write("The number of processes must be at least 1.\n")
+    sys.exit(1)
+
+if args.every < 1 or args.fps is not None and args.fps <= 0:
+    sys.stderr.write("The video frames to sample must be positive.\n")
+    sys.exit(1)
+
+webcam = 0 if args.webcam is None else args.webcam
+stride = args.stride or (None if args.tile is None else max(1, args.tile * 3 // 4))
+
+# Forward to `ml serve cvbp` when it is running, before loading
+# anything heavy.
+
+if client.forward("detect", options, args):
+    raise SystemExit(0)
 
 # ----------------------------------------------------------------------
-# Prepare processing function
+# Load the libraries, only now the arguments are known good
 # ----------------------------------------------------------------------
 
-# Load ResNet model.
+import utils
+import corpus
+import writers
 
-model = torchvision.models.detection.fasterrcnn_resnet50_fpn(
-    pretrained=True,
-    rpn_pre_nms_top_n_test = 5,
-    rpn_post_nms_top_n_test = 5,
-    max_size=200,
-)
+import cv2 as cv
 
-detector = DetectionLearner(
-    model=model, 
-    labels=coco_labels()[1:],  #  First element is '__background__'
-)
+from collections import deque
+from concurrent.futures import Future
+from itertools import tee
+from fetch import locate, release, released
 
-if len(args.path):
+from PIL import Image
 
-    for path in args.path:
+from utils_cv.detection.data import coco_labels
+from utils_cv.detection.model import DetectionLearner
+
+from scheduler import Batcher, aspect_bucket
+from detection import mean_average_precision, merge_tiles, tiles
+from tracking import Tracker, draw_tracks
+from results import ResultCache, digest
+from zoo import build_detector, detect_batch, fingerprint
+
+timing.record("import", timing.started)
+
+try:
+    shard = corpus.parse_shard(args.shard)
+except ValueError as e:
+    sys.stderr.write(f"{e}\n")
+    sys.exit(1)
+
+# ----------------------------------------------------------------------
+# Prepare processing function
+# ----------------------------------------------------------------------
+
+# Load the model with the chosen profile. Tiles are detected at their
+# own size rather than shrunk to the profile's.
+
+def load_detector(name, profile, **kwargs):
+    model = build_detector(name, profile, **kwargs)
+    return DetectionLearner(
+        model=model,
+        labels=coco_labels()[1:],  #  First element is '__background__'
+    )
+
+
+if args.tile is None:
+    detector = load_detector(args.model, args.profile)
+else:
+    detector = load_detector(args.model, args.profile, min_size=args.tile, max_size=args.tile)
+
+# Images already seen by the model with this profile are answered from
+# the result cache, by the content of the image. Every box the profile
+# keeps is stored, so that --threshold applies to cached results too.
+
+store = None if args.no_cache or args.evaluate else ResultCache(refresh=args.refresh)
+if args.tile is None:
+    key = fingerprint(args.model, args.profile)
+else:
+    key = fingerprint(args.model, args.profile, f"tile={args.tile}/{stride}")
+
+# The columns written, tracking adding the track number and videos the
+# frame and its time.
+
+columns = [
+    ("score", "float", ".2f"),
+    ("label", "str", ""),
+    ("left", "int", ""),
+    ("top", "int", ""),
+    ("right", "int", ""),
+    ("bottom", "int", ""),
+    ("track", "int", ""),
+    ("ms", "float", ".1f"),
+    ("frame", "int", ""),
+    ("seconds", "float", ".3f"),
+    ("path", "str", ""),
+]
+if not args.track:
+    columns = [c for c in columns if c[0] != "track"]
+if not args.timings:
+    columns = [c for c in columns if c[0] != "ms"]
+
+# ----------------------------------------------------------------------
+# Read the images, with urls fetched through the download cache
+# ----------------------------------------------------------------------
+
+def load_image(item):
+    """Read an image in a worker, keeping its path with it.
+
+    Videos are passed through to be read frame by frame. Images whose
+    objects are in the cache are not read.
+
+    :return: The path, the image, the hash of the image and the objects
+             found in the cache, or None.
+    """
+    path, imfile = item
+    if imfile is None or utils.is_video(path):
+        return path, imfile, None, None
+
+    try:
+        digested, found = None, None
+        if store is not None:
+            digested = digest(imfile)
+            found = store.get(digested, key)
+            if found is not None:
+                return path, None, digested, found
+        with timing.stage("decode"):
+            return path, Image.open(imfile).convert('RGB'), digested, None
+    except:
+        sys.stderr.write(f"'{imfile}' may not be an image file and " +
+                         f"will be skipped.\n")
+        return path, None, None, None
+    finally:
+        release(imfile)
+
+
+def load_frames(images):
+    """Expand videos into their sampled frames, passing images through.
+
+    :return: A generator of (path, frame, im, digested, found) where
+             frame is the (index, seconds) of a video frame or None for
+             an image.
+    """
+    for path, im, digested, found in images:
+        if not isinstance(im, str):
+            if im is not None or found is not None:
+                yield path, None, im, digested, found
+            continue
 
-        if is_url(path):
-            tempdir = tempfile.gettempdir()
-            imfile = os.path.join(tempdir, "temp.jpg")
-            urllib.request.urlretrieve(path, imfile)
-        else:
-            imfile = os.path.join(get_cmd_cwd(), path)
-    
         try:
-            im = Image.open(imfile).convert('RGB')
-        except:
+            for index, seconds, frame in utils.video_frames(im, args.every, args.fps):
+                yield path, (index, seconds), utils.cv2pil(frame), None, None
+        except OSError as e:
+            sys.stderr.write(f"{e} It will be skipped.\n")
+
+# ----------------------------------------------------------------------
+# Detect objects, decoding the next images while the model runs
+# ----------------------------------------------------------------------
+
+def detect_objects(ims):
+    """Detect the objects in a batch of images, as they are cached.
+
+    :return: For each image, the (score, label, left, top, right, bottom)
+             of every object the profile keeps.
+    """
+    if args.tile is not None:
+        return [detect_tiles(im) for im in ims]
+    return [[(b.score, b.label_name, b.left, b.top, b.right, b.bottom) for b in boxes]
+            for boxes in detect_batch(detector, ims, threshold=0)]
+
+
+def detect_tiles(im):
+    """Detect the objects in a large image, tile by tile.
+
+    The tiles are cropped and detected --tile-batch at a time, so that
+    only the image and one batch of tiles are held. Objects found in
+    more than one tile are merged, keeping the best, including those cut
+    short at the edge of a tile.
+
+    :return: As detect_objects() for the one image.
+    """
+    found = []
+    for batch in utils.batched(tiles(*im.size, args.tile, stride), args.tile_batch):
+        with timing.stage("preprocess"):
+            crops = [im.crop(tile) for tile in batch]
+        for tile, boxes in zip(batch, detect_batch(detector, crops, threshold=0)):
+            left, top = tile[:2]
+            found += [(b.score, b.label_name,
+                       (b.left + left, b.top + top, b.right + left, b.bottom + top), tile)
+                      for b in boxes]
+    with timing.stage("output"):
+        return [(score, label, *box)
+                for score, label, box in merge_tiles(found, *im.size)]
+
+
+def detect_timed(ims):
+    """As detect_objects(), with the milliseconds taken per image.
+    """
+    start = time.perf_counter()
+    found = detect_objects(ims)
+    ms = 1000 * (time.perf_counter() - start) / len(ims)
+    return [(objects, ms) for objects in found]
+
+
+def format_detections(path, frame, objects, ms=0.0):
+    """Return the rows for the objects identified in an image.
+
+    Video frames are reported by their index and time in seconds.
+
+    :param ms: The milliseconds the detector took, 0 for cached objects.
+    """
+    where = dict(path=path)
+    if frame is not None:
+        where.update(frame=frame[0], seconds=frame[1])
+    objects = [o for o in objects if o[0] > args.threshold]
+    if args.top_k is not None:
+        objects = sorted(objects, key=lambda o: -o[0])[:args.top_k]
+    with timing.stage("output"):
+        return [dict(score=score, label=label, left=left, top=top, right=right,
+                     bottom=bottom, ms=ms, **where)
+                for score, label, left, top, right, bottom in objects]
+
+
+def write_detections(path, frame, digested, future):
+    """Output the objects identified in an image.
+
+    :param digested: The hash of an image to cache the objects of, or
+                     None if they are not to be cached.
+    """
+    objects, ms = future.result()
+    if store is not None and digested is not None:
+        store.put(digested, key, objects)
+    writer.write(path, format_detections(path, frame, objects, ms))
+
+
+def completed(objects):
+    """Return a finished future for objects found in the cache."""
+    future = Future()
+    future.set_result((objects, 0.0))
+    return future
+
+
+def detect_paths(files):
+    """Read and detect objects in a chunk of fetched paths in a worker process.
+
+    :return: The path and the rows for each image or frame.
+    """
+    results = []
+    inputs = load_frames(map(load_image, files))
+    for batch in utils.batched(inputs, 1 if args.tile is not None else args.batch_size):
+        found = [(item[4], 0.0) for item in batch]
+        new = [i for i, (objects, _) in enumerate(found) if objects is None]
+        if len(new):
+            for i, (objects, ms) in zip(new, detect_timed([batch[i][2] for i in new])):
+                found[i] = objects, ms
+                if store is not None and batch[i][3] is not None:
+                    store.put(batch[i][3], key, objects)
+        results += [(path, format_detections(path, frame, objects, ms))
+                    for (path, frame, _, _, _), (objects, ms) in zip(batch, found)]
+    return results
+
+
+# ----------------------------------------------------------------------
+# Follow the objects through videos and the webcam
+# ----------------------------------------------------------------------
+
+def track_objects(frame):
+    """Detect the objects in an OpenCV frame for the tracker.
+    """
+    return [o for o in detect_objects([utils.cv2pil(frame)])[0] if o[0] > args.threshold]
+
+
+def new_tracker():
+    """Return a tracker, detecting on every frame unless --track.
+    """
+    return Tracker(track_objects, args.keyframes if args.track else 1)
+
+
+def format_tracks(path, frame, tracks, ms):
+    """Return the rows for the objects followed in a frame.
+
+    As format_detections() with the track number after the box.
+    """
+    tracks = [t for t in tracks if t[1] > args.threshold]
+    if args.top_k is not None:
+        tracks = sorted(tracks, key=lambda t: -t[1])[:args.top_k]
+    rows = format_detections(path, frame, [t[1:] for t in tracks], ms)
+    for row, (track, *_) in zip(rows, tracks):
+        row["track"] = track
+    return rows
+
+
+def follow(tracker, frame):
+    """Return the tracks in a frame and the milliseconds taken."""
+    start = time.perf_counter()
+    tracks = tracker(frame)
+    return tracks, 1000 * (time.perf_counter() - start)
+
+
+def track_path(item):
+    """Detect and follow the objects through a video, or in an image.
+
+    :return: The path and the rows for each frame.
+    """
+    path, imfile = item
+    if imfile is None:
+        return []
+
+    tracker = new_tracker()
+    if not utils.is_video(path):
+        frame = cv.imread(imfile)
+        release(imfile)
+        if frame is None:
             sys.stderr.write(f"'{imfile}' may not be an image file and " +
                              f"will be skipped.\n")
-            continue
+            return []
+        return [(path, format_tracks(path, None, *follow(tracker, frame)))]
+
+    results = []
+    try:
+        for index, seconds, frame in utils.video_frames(imfile, args.every, args.fps):
+            results.append((path, format_tracks(path, (index, seconds),
+                                                *follow(tracker, frame))))
+    except OSError as e:
+        sys.stderr.write(f"{e} It will be skipped.\n")
+    sys.stderr.write(f"'{path}': {tracker.report()}.\n")
+    return results
+
+# ----------------------------------------------------------------------
+# Evaluate the profiles against the most accurate model
+# ----------------------------------------------------------------------
+
+def evaluate(ims):
+    """Report the latency and mAP of each profile of the chosen model.
+
+    There being no ground truth for the images, the mAP is against the
+    objects the accurate profile of the resnet50 model detects, which so
+    scores 1.0 against itself.
+    """
+    def run(name, profile):
+        learner = load_detector(name, profile)
+        found, times = [], []
+        for im in ims:
+            start = time.perf_counter()
+            boxes = detect_batch(learner, [im], args.threshold)[0]
+            times.append(time.perf_counter() - start)
+            found.append([(b.score, b.label_name, (b.left, b.top, b.right, b.bottom))
+                          for b in boxes])
+        return found, sorted(times)[len(times) // 2]
+
+    reference = ("fasterrcnn_resnet50_fpn", "accurate")
+    if args.model == reference[0]:
+        sys.stderr.write(f"The mAP is against the {reference[1]} profile of " +
+                         f"{reference[0]}, so that profile scores 1.000 by definition.\n")
+
+    expected = run(*reference)
+    truth = [[(label, box) for _, label, box in dets] for dets in expected[0]]
+    print("profile,model,ms,map")
+    for profile in profiles:
+        if (args.model, profile) == reference:
+            found, latency = expected
+        else:
+            found, latency = run(args.model, profile)
+        score = mean_average_precision(found, truth)
+        score = "" if score is None else f"{score:.3f}"
+        print(f"{profile},{args.model},{1000 * latency:.1f},{score}")
+
+
+# Paths are streamed from the directories, globs and manifest, skipping
+# those in other shards and those an earlier run has already written.
+
+writer = None if args.evaluate else writers.open_writer(args.format, args.output, columns)
+done = set() if writer is None else writer.done
+
+paths = (p for p in corpus.expand(args.path, args.manifest)
+         if corpus.in_shard(p, shard) and p not in done)
+
+if args.evaluate:
+    files = utils.prefetch(locate, paths, args.fetchers)
+    images = utils.prefetch(load_image, files, args.workers)
+    evaluate([im for _, _, im, _, _ in load_frames(images)])
+    sys.exit(0)
+
+# ----------------------------------------------------------------------
+# Detect the objects
+# ----------------------------------------------------------------------
 
-        # Output the objects identified.
+if listed and args.track:
 
-        detections = detector.predict(im)
-        for a in detections['det_bboxes']:
-            sys.stdout.write(f"{a.score:.2f},{a.label_name}," +
-                             f"{a.left},{a.top},{a.right},{a.bottom}," +
-                             f"{path}\n")
+    # Each video is followed from start to end by one worker, detecting
+    # only on its keyframes. Images are single keyframes.
+
+    files = utils.prefetch(locate, paths, args.fetchers)
+    if args.procs > 1:
+        files, sent = tee(files)
+        tracked = released(utils.fork_map(track_path, files, args.procs),
+                           ([item] for item in sent))
+    else:
+        tracked = map(track_path, files)
+    for results in tracked:
+        for path, rows in results:
+            writer.write(path, rows)
+
+    writer.close()
+
+elif listed and args.tile is not None and args.procs == 1:
+
+    # Large images are read and detected one at a time, with none read
+    # ahead, so that only one is held whole beside a batch of its tiles.
+
+    files = utils.prefetch(locate, paths, args.fetchers)
+    for path, frame, im, digested, found in load_frames(map(load_image, files)):
+        if found is None:
+            found, ms = detect_timed([im])[0]
+            if store is not None and digested is not None:
+                store.put(digested, key, found)
+        else:
+            ms = 0.0
+        writer.write(path, format_detections(path, frame, found, ms))
+
+    writer.close()
+
+elif listed and args.procs > 1:
+
+    # The detector was loaded before the workers are forked so that they
+    # share it. Each worker reads and detects in a chunk of paths, one
+    # image at a time with --tile, fetched here so that only this process
+    # evicts from the cache.
+
+    files = utils.prefetch(locate, paths, args.fetchers)
+    chunks, sent = tee(utils.batched(files, args.batch_size))
+    for results in released(utils.fork_map(detect_paths, chunks, args.procs), sent):
+        for path, rows in results:
+            writer.write(path, rows)
+
+    writer.close()
+
+elif listed:
+
+    # Images are batched with others of a similar shape, so a window of
+    # several batches is kept in flight for the buckets to fill from.
+    # The results are still written in the order of the paths.
+
+    batcher = Batcher(detect_timed, args.batch_size, max_wait=0.05, key=aspect_bucket)
+    pending = deque()
+
+    files = utils.prefetch(locate, paths, args.fetchers)
+    images = utils.prefetch(load_image, files, args.workers)
+    inputs = utils.background(load_frames(images), 2 * args.batch_size)
+    for path, frame, im, digested, found in inputs:
+
+        if found is None:
+            pending.append((path, frame, digested, batcher.submit(im)))
+        else:
+            pending.append((path, frame, None, completed(found)))
+        if len(pending) >= 4 * args.batch_size:
+            write_detections(*pending.popleft())
 
-# else:
-    
-#     # ------------------------------------------------------------------------
-#     # Webcam object detection
-#     # ------------------------------------------------------------------------
+    while pending:
+        write_detections(*pending.popleft())
+    batcher.close()
 
-#     def detect_frame(capture, model, label):
-#         """Use the learner to detect objects.
-#         """
-#         _, frame = capture.read()  # Capture frame-by-frame
-#         #        preds = model([utils.cv2torch(frame)])
-#         #        anno_bboxes = _get_det_bboxes(preds, labels=label)
+    writer.close()
 
-#         detections = detector.predict(utils.cv2torch(frame))
-#         im_pil = utils.cv2pil(frame)
-#         plot_boxes(im_pil, detections['det_bboxes'],
-#                    plot_settings=PlotSettings(rect_color=(0, 255, 0)))
-#         return utils.pil2matplotlib(im_pil)
+else:
 
-#     func = partial(detect_frame, model=model, label=coco_labels()[1:])
+    # ------------------------------------------------------------------------
+    # Webcam object detection
+    # ------------------------------------------------------------------------
 
-#     # ----------------------------------------------------------------------
-#     # Run webcam to show processed results.
-#     # ----------------------------------------------------------------------
+    tracker = new_tracker()
 
-#     utils.process_webcam(func, webcam)
+    def detect_frame(frame):
+        """Detect or follow the objects in a webcam frame and draw them.
+        """
+        return utils.cv2matplotlib(draw_tracks(frame, tracker(frame)))
 
-#     sys.exit(0)
+    # ----------------------------------------------------------------------
+    # Run webcam to show processed results.
+    # ----------------------------------------------------------------------
 
+    utils.process_webcam(detect_frame, webcam, rates={"keyframes": tracker.keyframes})
 
-        
+    sys.exit(0)
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# Author: Graham.Williams@microsoft.com
+#
+# Helpers for working with detected bounding boxes.
+#
+# Boxes are (left, top, right, bottom) in pixels as in the output of
+# detect. Detections are (score, label, box) and references (label, box).
+#
+# From the Microsoft Best Practices Suite: Computer Vision
+# https://github.com/microsoft/ComputerVision
+
+
+def iou(a, b):
+    """Return the intersection over union of two boxes.
+    """
+    width = min(a[2], b[2]) - max(a[0], b[0])
+    height = min(a[3], b[3]) - max(a[1], b[1])
+    if width <= 0 or height <= 0:
+        return 0.0
+    inter = width * height
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union
+
+
+def ios(a, b):
+    """Return the intersection over the smaller of two boxes.
+
+    A box cut short at the edge of a tile lies mostly within the whole
+    box found in the next tile, though their union is much larger.
+    """
+    width = min(a[2], b[2]) - max(a[0], b[0])
+    height = min(a[3], b[3]) - max(a[1], b[1])
+    if width <= 0 or height <= 0:
+        return 0.0
+    smaller = min((a[2] - a[0]) * (a[3] - a[1]), (b[2] - b[0]) * (b[3] - b[1]))
+    return width * height / smaller
+
+
+def nms(detections, threshold=0.5, overlap=iou):
+    """Return the detections not overlapping a better one of their label.
+
+    :param detections: The detections, in any order.
+    :param threshold: The overlap above which the lesser is dropped.
+    :param overlap: The measure of overlap between two boxes.
+    :return: The detections kept, best score first.
+    """
+    kept = []
+    for score, label, box in sorted(detections, key=lambda d: -d[0]):
+        if all(l != label or overlap(box, b) <= threshold for _, l, b in kept):
+            kept.append((score, label, box))
+    return kept
+
+
+def cut_short(box, tile, width, height, margin=1):
+    """Whether a box found in a tile touches an edge inside the image.
+    """
+    return (tile[0] > 0 and box[0] - tile[0] <= margin) or \
+        (tile[1] > 0 and box[1] - tile[1] <= margin) or \
+        (tile[2] < width and tile[2] - box[2] <= margin) or \
+        (tile[3] < height and tile[3] - box[3] <= margin)
+
+
+def merge_tiles(detections, width, height, threshold=0.5):
+    """Return the detections of the tiles of an image, each object once.
+
+    Boxes are compared by iou() as in nms(), except for a box cut short
+    at the edge of its tile and one from another tile, compared by
+    ios(). So objects overlapping within a tile, already separated by
+    the detector, are all kept. Whole boxes are preferred to those cut
+    short, whatever their scores.
+
+    :param detections: The (score, label, box, tile) found in each tile,
+                       the box in the coordinates of the image.
+    :param width: The width of the image.
+    :param height: The height of the image.
+    :param threshold: The overlap above which the lesser is dropped.
+    :return: The (score, label, box) kept, best score first.
+    """
+    ranked = sorted(((cut_short(box, tile, width, height), -score, label, box, tile)
+                     for score, label, box, tile in detections), key=lambda d: d[:2])
+    kept = []
+    for cut, score, label, box, tile in ranked:
+
+        def overlap(other, other_tile, other_cut):
+            seam = other_tile != tile and (cut or other_cut)
+            return (ios if seam else iou)(box, other)
+
+        if all(l != label or overlap(b, t, c) <= threshold for c, _, l, b, t in kept):
+            kept.append((cut, score, label, box, tile))
+    return [(-score, label, box) for _, score, label, box, _ in sorted(kept, key=lambda d: d[1])]
+
+
+def tiles(width, height, size, stride):
+    """Return the overlapping square tiles covering an image.
+
+    The last row and column of tiles end at the edge of the image, so
+    that every tile is whole unless the image is smaller than a tile.
+
+    :param size: The width and height of the tiles.
+    :param stride: The distance between the tiles, at most size.
+    :return: The tiles as boxes.
+    """
+    def starts(length):
+        last = max(length - size, 0)
+        return sorted(set(range(0, last, stride)) | {last})
+
+    return [(left, top, min(left + size, width), min(top + size, height))
+            for top in starts(height) for left in starts(width)]
+
+
+def average_precision(detections, references, label, threshold=0.5):
+    """Return the average precision for one label over many images.
+
+    Detections are matched, best score first, to the unmatched reference
+    they overlap most if that is at least threshold. The precision is
+    interpolated at every recall, as for Pascal VOC since 2010.
+
+    :param detections: The detections in each image.
+    :param references: The references in each image.
+    :param label: The label to measure.
+    :param threshold: The least intersection over union to match.
+    :return: The average precision, or None if the label has no references.
+    """
+    truth = [[box for l, box in refs if l == label] for refs in references]
+    total = sum(len(boxes) for boxes in truth)
+    if not total:
+        return None
+
+    found = sorted(((score, i, box) for i, dets in enumerate(detections)
+                    for score, l, box in dets if l == label),
+                   key=lambda d: -d[0])
+    matched = [[False] * len(boxes) for boxes in truth]
+    hits = []
+    for _, i, box in found:
+        overlaps = [(iou(box, ref), j) for j, ref in enumerate(truth[i]) if not matched[i][j]]
+        best, j = max(overlaps, default=(0.0, None))
+        hit = j is not None and best >= threshold
+        if hit:
+            matched[i][j] = True
+        hits.append(hit)
+
+    precisions, recalls, tp = [], [], 0
+    for n, hit in enumerate(hits, 1):
+        tp += hit
+        precisions.append(tp / n)
+        recalls.append(tp / total)
+
+    ap, previous = 0.0, 0.0
+    for k, recall in enumerate(recalls):
+        if recall > previous:
+            ap += (recall - previous) * max(precisions[k:])
+            previous = recall
+    return ap
+
+
+def mean_average_precision(detections, references, threshold=0.5):
+    """Return the mean over labels of the average precision.
+
+    :param detections: The detections in each image.
+    :param references: The references in each image.
+    :param threshold: The least intersection over union to match.
+    :return: The mAP, or None if there are no references.
+    """
+    labels = {l for refs in references for l, _ in refs}
+    aps = [average_precision(detections, references, l, threshold) for l in labels]
+    aps = [ap for ap in aps if ap is not None]
+    return sum(aps) / len(aps) if aps else None
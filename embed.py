@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# Author: Graham.Williams@microsoft.com
+#
+# A command line script to index the features of images from one of the
+# classifiers and to find the images most like another.
+#
+# ml embed cvbp [<path>] [--query=<path>]
+#
+# From the Microsoft Best Practices Suite: Computer Vision
+# https://github.com/microsoft/ComputerVision
+
+# ----------------------------------------------------------------------
+# Setup.
+# ----------------------------------------------------------------------
+
+import timing
+
+# Required libraries.
+
+import sys
+import argparse
+
+from catalogue import all_models
+
+# ----------------------------------------------------------------------
+# Parse command line arguments: path --model= --query=
+# ----------------------------------------------------------------------
+
+options = argparse.ArgumentParser(add_help=False)
+
+options.add_argument(
+    'path',
+    nargs="*",
+    help='path, url, directory or quoted glob of images to add to the index')
+
+options.add_argument(
+    '--manifest',
+    help="file listing further paths or urls, one per line, - for stdin")
+
+options.add_argument(
+    '-m', '--model',
+    default="resnet50",
+    help="model to take the features from (default is resnet50)")
+
+options.add_argument(
+    '--index',
+    help="directory of the index (default is one per model in the cache)")
+
+options.add_argument(
+    '-q', '--query',
+    action='append',
+    help="find the images in the index most like this one (may be repeated)")
+
+options.add_argument(
+    '-k', '--neighbours',
+    type=int,
+    default=5,
+    help="number of similar images to find (default is 5)")
+
+options.add_argument(
+    '--exact',
+    action='store_true',
+    help="compare with every image rather than the nearest cells of the index")
+
+options.add_argument(
+    '--nprobe',
+    type=int,
+    default=8,
+    help="cells of the index to search when not exact (default is 8)")
+
+options.add_argument(
+    '-b', '--batch-size',
+    type=int,
+    default=16,
+    help="number of images per forward pass (default is 16)")
+
+options.add_argument(
+    '--fetchers',
+    type=int,
+    default=8,
+    help="concurrent downloads of image urls (default is 8)")
+
+options.add_argument(
+    '--workers',
+    type=int,
+    default=0,
+    help="threads to decode images ahead of the model (default is 0)")
+
+args = options.parse_args()
+
+if args.model == "list":
+    for m in all_models: print(m)
+    sys.exit(0)
+elif args.model not in all_models:
+    sys.stderr.write(f"Selected model '{args.model}' is not known.\n")
+    sys.exit(1)
+
+if not len(args.path) and args.manifest is None and args.query is None:
+    sys.stderr.write("Please supply the images to index, or --query to search for.\n")
+    sys.exit(1)
+
+if args.neighbours < 1 or args.nprobe < 1:
+    sys.stderr.write("The neighbours and cells to search must be at least 1.\n")
+    sys.exit(1)
+
+if args.batch_size < 1:
+    sys.stderr.write("The batch size must be at least 1.\n")
+    sys.exit(1)
+
+if args.workers < 0 or args.fetchers < 0:
+    sys.stderr.write("The number of workers can not be negative.\n")
+    sys.exit(1)
+
+# ----------------------------------------------------------------------
+# Load the libraries, only now the arguments are known good
+# ----------------------------------------------------------------------
+
+import os
+import torch
+
+import utils
+import corpus
+
+from fetch import locate, release
+
+from fastai.vision import open_image
+
+from mlhub.pkg import is_url
+from mlhub.utils import get_cmd_cwd
+
+from utils_cv.classification.model import IMAGENET_IM_SIZE
+
+from embeddings import EmbeddingIndex
+from zoo import build_embedder, embed_batch, fingerprint, image_batch, prepare_image
+
+timing.record("import", timing.started)
+
+model = build_embedder(args.model)
+size = embed_batch(model, torch.zeros(1, 3, IMAGENET_IM_SIZE, IMAGENET_IM_SIZE)).shape[1]
+
+if args.index is None:
+    directory = utils.cache_dir("embeddings", args.model)
+else:
+    directory = os.path.join(get_cmd_cwd(), args.index)
+
+try:
+    index = EmbeddingIndex(directory, args.model, fingerprint(args.model, "embed"), size)
+except ValueError as e:
+    sys.stderr.write(f"{e}\n")
+    sys.exit(1)
+
+# ----------------------------------------------------------------------
+# Read the images, with urls fetched through the download cache
+# ----------------------------------------------------------------------
+
+def load_image(item):
+    """Read and resize an image in a worker, keeping its path with it.
+
+    :return: The path and the image tensor, or None if it can not be read.
+    """
+    path, imfile = item
+    if imfile is None:
+        return path, None
+    try:
+        with timing.stage("decode"):
+            im = open_image(imfile, convert_mode='RGB')
+    except:
+        sys.stderr.write(f"'{imfile}' may not be an image file and will be skipped.\n")
+        return path, None
+    finally:
+        release(imfile)
+    return path, prepare_image(im)
+
+
+def embed_paths(paths):
+    """Yield the paths of the images read and their embeddings, a batch at a time.
+    """
+    files = utils.prefetch(locate, paths, args.fetchers)
+    images = utils.prefetch(load_image, files, args.workers,
+                            depth=2 * max(args.workers, args.batch_size))
+    for batch in utils.batched(((p, x) for p, x in images if x is not None),
+                               args.batch_size):
+        yield [p for p, _ in batch], embed_batch(model, image_batch([x for _, x in batch]))
+
+# ----------------------------------------------------------------------
+# Add the new images to the index
+# ----------------------------------------------------------------------
+
+# Local images are indexed by their absolute path, so that the index
+# may be added to and searched from any directory. Images already in the
+# index are skipped, so that the same command run again as images
+# arrive adds only the new ones. Videos are not indexed.
+
+def absolute(path):
+    """Return the absolute path of a local image, leaving urls."""
+    return path if is_url(path) else os.path.abspath(os.path.join(get_cmd_cwd(), path))
+
+
+paths = (absolute(p) for p in corpus.expand(args.path, args.manifest)
+         if not utils.is_video(p))
+paths = (p for p in paths if p not in index.known)
+
+added = 0
+for batch, vectors in embed_paths(paths):
+    with timing.stage("index"):
+        index.add(batch, vectors)
+    added += len(batch)
+
+if added:
+    sys.stderr.write(f"Added {added} images to the index of {len(index)} in {directory}.\n")
+
+# ----------------------------------------------------------------------
+# Find the images most like each query
+# ----------------------------------------------------------------------
+
+if args.query is not None:
+    for batch, vectors in embed_paths(args.query):
+        for query, vector in zip(batch, vectors):
+            with timing.stage("search"):
+                found = index.search(vector, args.neighbours, args.exact, args.nprobe)
+            for score, path in found:
+                print(f"{score:.2f},{path},{query}")
+
+index.close()
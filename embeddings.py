@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# Author: Graham.Williams@microsoft.com
+#
+# An index of image embeddings for near-duplicate and similarity search.
+#
+# The embeddings are L2 normalised, so that their inner product is the
+# cosine similarity. An index is a directory holding
+#
+#   meta.json       the model, its fingerprint and the dimension.
+#   vectors.f16     the embeddings as a float16 matrix, a row per image.
+#   paths.txt       the path of each row, one per line.
+#   quantizers.npz  once trained, the coarse cells and the product
+#                   quantization codebooks.
+#   cells.i32       once trained, the cell of each row.
+#   codes.u8        once trained, the product quantization code of each row.
+#
+# Rows are only ever appended, and are read through memory maps, so the
+# index grows with new images without being rebuilt or held in memory.
+# The path is written last, so a row without one was interrupted and is
+# dropped on opening.
+#
+# Until TRAIN_SIZE rows are held every query is exact. The quantizers
+# are then trained once, on a sample, and each new row is assigned its
+# cell and code as it is added. An approximate query (IVF-PQ) scores
+# only the rows in the nprobe cells nearest the query, by their codes,
+# and ranks the best of those again by their float16 embeddings.
+#
+# From the Microsoft Best Practices Suite: Computer Vision
+# https://github.com/microsoft/ComputerVision
+
+import json
+import os
+
+import numpy as np
+
+TRAIN_SIZE = 10000  # Rows to train the quantizers on, once reached.
+CELLS = 256         # Coarse cells, each holding a list of rows.
+CENTROIDS = 256     # Centroids in each subspace, one byte per code.
+CHUNK = 65536       # Rows read at a time when scanning the index.
+
+
+def kmeans(x, k, iterations=10, seed=0):
+    """Cluster the rows of x into k centroids by Lloyd's algorithm.
+
+    Empty clusters are restarted from a random row.
+
+    :return: The centroids.
+    """
+    rng = np.random.default_rng(seed)
+    x = np.asarray(x, dtype=np.float32)
+    k = min(k, len(x))
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    for _ in range(iterations):
+        nearest = assign(x, centroids)
+        counts = np.bincount(nearest, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, nearest, x)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        centroids[empty] = x[rng.choice(len(x), int(empty.sum()))]
+    return centroids
+
+
+def assign(x, centroids):
+    """Return the index of the nearest centroid to each row of x."""
+    norms = (centroids ** 2).sum(axis=1)
+    return np.concatenate([np.argmin(norms - 2 * x[i:i + CHUNK] @ centroids.T, axis=1)
+                           for i in range(0, len(x), CHUNK)])
+
+
+def top(scores, k):
+    """Return the indices of the k highest scores, highest first."""
+    k = min(k, len(scores))
+    best = np.argpartition(-scores, k - 1)[:k]
+    return best[np.argsort(-scores[best])]
+
+
+class EmbeddingIndex:
+    """The embeddings of images, by path, with exact and approximate k-NN.
+    """
+
+    def __init__(self, directory, model=None, fingerprint=None, dim=None):
+        """Open an index, creating it for the model if it is new.
+
+        :param directory: The directory holding the index.
+        :param model: The name of the model the embeddings are from.
+        :param fingerprint: The model's fingerprint, to check an
+                            existing index was built with the same
+                            weights and preprocessing.
+        :param dim: The dimension of the embeddings.
+        :raises ValueError: If the index was built with another model.
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+        meta = self._file("meta.json")
+        if os.path.exists(meta):
+            with open(meta) as f:
+                self.meta = json.load(f)
+            if fingerprint is not None and self.meta["fingerprint"] != fingerprint:
+                raise ValueError(f"The index '{directory}' holds embeddings of " +
+                                 f"{self.meta['model']}, not of these weights.")
+        else:
+            self.meta = dict(model=model, fingerprint=fingerprint, dim=dim)
+            with open(meta, "w") as f:
+                json.dump(self.meta, f)
+        self.dim = self.meta["dim"]
+
+        self.trained = os.path.exists(self._file("quantizers.npz"))
+        if self.trained:
+            quantizers = np.load(self._file("quantizers.npz"))
+            self.cells, self.codebooks = quantizers["cells"], quantizers["codebooks"]
+        else:
+            for name in ("cells.i32", "codes.u8"):  # From interrupted training.
+                if os.path.exists(self._file(name)):
+                    os.remove(self._file(name))
+
+        self._recover()
+        self.known = set(self.paths)
+        self.files = {name: open(self._file(name), "ab")
+                      for name in self._matrices()}
+        self.path_file = open(self._file("paths.txt"), "a")
+        self._maps = {}
+
+    def _file(self, name):
+        return os.path.join(self.directory, name)
+
+    def _matrices(self):
+        """Return the files of rows, each with its dtype and width."""
+        files = {"vectors.f16": (np.float16, self.dim)}
+        if self.trained:
+            files.update({"cells.i32": (np.int32, 1),
+                          "codes.u8": (np.uint8, len(self.codebooks))})
+        return files
+
+    def _recover(self):
+        """Read the paths, cutting every file back to the complete rows."""
+        self.paths, offset = [], 0
+        if os.path.exists(self._file("paths.txt")):
+            with open(self._file("paths.txt"), "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    self.paths.append(line[:-1].decode("utf-8"))
+                    offset += len(line)
+
+        rows = len(self.paths)
+        for name, (dtype, width) in self._matrices().items():
+            size = os.path.getsize(self._file(name)) if os.path.exists(self._file(name)) else 0
+            rows = min(rows, size // (np.dtype(dtype).itemsize * width))
+        if rows < len(self.paths):
+            offset = sum(len(p.encode("utf-8")) + 1 for p in self.paths[:rows])
+            self.paths = self.paths[:rows]
+
+        with open(self._file("paths.txt"), "ab") as f:
+            f.truncate(offset)
+        for name, (dtype, width) in self._matrices().items():
+            with open(self._file(name), "ab") as f:
+                f.truncate(rows * np.dtype(dtype).itemsize * width)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def _map(self, name):
+        """Return the rows of a file as a read only memory map."""
+        dtype, width = self._matrices()[name]
+        cached = self._maps.get(name)
+        if cached is None or len(cached) != len(self):
+            self.files[name].flush()
+            cached = np.memmap(self._file(name), dtype=dtype, mode="r",
+                               shape=(len(self), width)) if len(self) else \
+                np.zeros((0, width), dtype=dtype)
+            self._maps[name] = cached
+        return cached
+
+    def add(self, paths, vectors):
+        """Append the embeddings of new images.
+
+        :param paths: The path of each image.
+        :param vectors: The L2 normalised embeddings, a row per path.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        self.files["vectors.f16"].write(vectors.astype(np.float16).tobytes())
+        if self.trained:
+            cells, codes = self._encode(vectors)
+            self.files["cells.i32"].write(cells.astype(np.int32).tobytes())
+            self.files["codes.u8"].write(codes.tobytes())
+        for f in self.files.values():
+            f.flush()
+        self.path_file.write("".join(f"{p}\n" for p in paths))
+        self.path_file.flush()
+        self.paths += paths
+        self.known.update(paths)
+
+        if not self.trained and len(self) >= TRAIN_SIZE:
+            self.train()
+
+    def _encode(self, vectors):
+        """Return the cell and product quantization code of each vector."""
+        cells = assign(vectors, self.cells)
+        sub = vectors.reshape(len(vectors), len(self.codebooks), -1)
+        codes = np.stack([assign(sub[:, j], book) for j, book in enumerate(self.codebooks)],
+                         axis=1)
+        return cells, codes.astype(np.uint8)
+
+    def train(self, size=TRAIN_SIZE):
+        """Train the quantizers on a sample of the rows, then encode them all.
+        """
+        vectors = self._map("vectors.f16")
+        rng = np.random.default_rng(0)
+        sample = np.sort(rng.choice(len(vectors), min(size, len(vectors)), replace=False))
+        sample = vectors[sample].astype(np.float32)
+
+        width = 16  # Each subspace's share of the dimension.
+        while self.dim % width:
+            width //= 2
+        split = sample.reshape(len(sample), -1, width)
+        self.cells = kmeans(sample, CELLS)
+        self.codebooks = np.stack([kmeans(split[:, j], CENTROIDS)
+                                   for j in range(split.shape[1])])
+
+        with open(self._file("cells.i32"), "wb") as cells, \
+             open(self._file("codes.u8"), "wb") as codes:
+            for i in range(0, len(vectors), CHUNK):
+                c, q = self._encode(vectors[i:i + CHUNK].astype(np.float32))
+                cells.write(c.astype(np.int32).tobytes())
+                codes.write(q.tobytes())
+
+        np.savez(self._file("quantizers.tmp.npz"), cells=self.cells, codebooks=self.codebooks)
+        os.replace(self._file("quantizers.tmp.npz"), self._file("quantizers.npz"))
+        self.trained = True
+        self.files.update({name: open(self._file(name), "ab")
+                           for name in ("cells.i32", "codes.u8")})
+
+    def search(self, query, k=10, exact=False, nprobe=8, rerank=10):
+        """Return the k nearest images to a query embedding.
+
+        :param query: The L2 normalised embedding.
+        :param exact: Score every row rather than only the nearest cells.
+        :param nprobe: The cells to score, for an approximate search.
+        :param rerank: The multiple of k scored by their codes to be
+                       ranked again by their embeddings.
+        :return: The (similarity, path) of the nearest, most similar first.
+        """
+        query = np.asarray(query, dtype=np.float32)
+        vectors = self._map("vectors.f16")
+        if not len(vectors):
+            return []
+
+        if exact or not self.trained:
+            best, scores = np.zeros(0, dtype=int), np.zeros(0, dtype=np.float32)
+            for i in range(0, len(vectors), CHUNK):
+                chunk = vectors[i:i + CHUNK].astype(np.float32) @ query
+                scores = np.concatenate([scores, chunk])
+                best = np.concatenate([best, np.arange(i, i + len(chunk))])
+                keep = top(scores, k)
+                best, scores = best[keep], scores[keep]
+            return [(float(s), self.paths[i]) for s, i in zip(scores, best)]
+
+        probe = top(self.cells @ query, nprobe)
+        rows = np.flatnonzero(np.isin(self._map("cells.i32")[:, 0], probe))
+        if not len(rows):
+            return []
+
+        sub = query.reshape(len(self.codebooks), -1)
+        tables = np.einsum("jcw,jw->jc", self.codebooks, sub)
+        codes = self._map("codes.u8")[rows]
+        approx = tables[np.arange(len(self.codebooks)), codes].sum(axis=1)
+        rows = np.sort(rows[top(approx, rerank * k)])
+
+        scores = vectors[rows].astype(np.float32) @ query
+        return [(float(scores[i]), self.paths[rows[i]]) for i in top(scores, k)]
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.path_file.close()
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# Author: Graham.Williams@microsoft.com
+#
+# Combine the classes predicted by several models into one answer.
+#
+# Each model's prediction is its most likely classes as [probability,
+# index] pairs, as kept in the result cache (see results.top_classes()),
+# so that cached and new predictions combine alike.
+#
+# From the Microsoft Best Practices Suite: Computer Vision
+# https://github.com/microsoft/ComputerVision
+
+from collections import Counter, defaultdict
+
+
+def mean_probability(tops):
+    """Return the class with the highest probability averaged over models.
+
+    A class outside a model's most likely classes counts as 0 for it.
+
+    :param tops: The most likely classes of each model.
+    :return: The mean probability and the index of the class.
+    """
+    totals = defaultdict(float)
+    for top in tops:
+        for prob, ind in top:
+            totals[ind] += prob
+    ind = max(totals, key=totals.get)
+    return totals[ind] / len(tops), ind
+
+
+def top_k_vote(tops):
+    """Return the class among the most models' most likely classes.
+
+    Ties go to the class with the higher total probability.
+
+    :param tops: The most likely classes of each model.
+    :return: The share of the models voting for the class, and its index.
+    """
+    votes, totals = Counter(), defaultdict(float)
+    for top in tops:
+        for prob, ind in top:
+            votes[ind] += 1
+            totals[ind] += prob
+    ind = max(votes, key=lambda i: (votes[i], totals[i]))
+    return votes[ind] / len(tops), ind
+
+
+methods = {
+    "mean": mean_probability,
+    "vote": top_k_vote,
+}
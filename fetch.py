@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# Author: Graham.Williams@microsoft.com
+#
+# Download images from urls into a local content addressed cache.
+#
+# Each url is recorded against the SHA256 hash of the content it
+# returned, and the content is stored once under that hash. Repeated
+# runs over the same urls are then read from the cache without touching
+# the network. Connections are kept open per thread and reused for
+# further requests to the same host.
+#
+# From the Microsoft Best Practices Suite: Computer Vision
+# https://github.com/microsoft/ComputerVision
+
+import hashlib
+import http.client
+import os
+import sys
+import tempfile
+import threading
+import urllib.parse
+
+from collections import Counter
+
+from mlhub.pkg import is_url
+from mlhub.utils import get_cmd_cwd
+
+import timing
+
+from utils import cache_dir, is_video
+
+MAX_REDIRECTS = 5
+TIMEOUT = 30
+
+# The cache is bounded in size, with the least recently used content
+# evicted first. The bound is in bytes and may be set through the
+# environment.
+
+CACHE_SIZE = int(os.environ.get("CVBP_DOWNLOAD_CACHE_SIZE", 2**30))
+
+# Content handed out by fetch() is pinned until released, so that room
+# made for later downloads never removes a file still waiting to be
+# read. Pins are kept within the process, so with --procs the urls are
+# fetched in the parent and released there once the workers are done
+# with them, and only the parent ever evicts.
+
+_local = threading.local()
+_lock = threading.Lock()
+_total = None
+_pinned = Counter()
+
+
+def _connection(scheme, netloc):
+    """Return an open connection to a host, reused within a thread.
+    """
+    conns = getattr(_local, "conns", None)
+    if conns is None:
+        conns = _local.conns = {}
+
+    conn = conns.get((scheme, netloc))
+    if conn is None:
+        if scheme == "https":
+            conn = http.client.HTTPSConnection(netloc, timeout=TIMEOUT)
+        else:
+            conn = http.client.HTTPConnection(netloc, timeout=TIMEOUT)
+        conns[(scheme, netloc)] = conn
+    return conn
+
+
+def _drop_connection(scheme, netloc):
+    conn = _local.conns.pop((scheme, netloc), None)
+    if conn is not None:
+        conn.close()
+
+
+def download(url):
+    """Download the content of a url over a reused connection.
+
+    :param url: The http or https url.
+    :return: The bytes of the content.
+    """
+    for _ in range(MAX_REDIRECTS + 1):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ("http", "https"):
+            raise ValueError(f"Unsupported url '{url}'.")
+        target = urllib.parse.urlunsplit(("", "", parts.path or "/", parts.query, ""))
+
+        # A kept alive connection may have been closed by the server, in
+        # which case reconnect once.
+
+        for retry in (True, False):
+            conn = _connection(parts.scheme, parts.netloc)
+            try:
+                conn.request("GET", target, headers={"User-Agent": "cvbp"})
+                response = conn.getresponse()
+                body = response.read()
+                break
+            except (http.client.HTTPException, ConnectionError):
+                _drop_connection(parts.scheme, parts.netloc)
+                if not retry:
+                    raise
+
+        if response.will_close:
+            _drop_connection(parts.scheme, parts.netloc)
+
+        if response.status in (301, 302, 303, 307, 308):
+            url = urllib.parse.urljoin(url, response.getheader("Location"))
+            continue
+        if response.status != 200:
+            raise OSError(f"Failed to download '{url}': " +
+                          f"{response.status} {response.reason}.")
+        return body
+
+    raise OSError(f"Too many redirects downloading '{url}'.")
+
+
+def _url_file(url):
+    digest = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir("downloads", "urls"), digest)
+
+
+def _object_file(digest):
+    return os.path.join(cache_dir("downloads", "objects", digest[:2]), digest)
+
+
+def _write(path, data):
+    """Write a file atomically so concurrent readers never see part of it.
+    """
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(temp, path)
+
+
+def cached(url):
+    """Return the cached file for a url, or None if it is not cached.
+    """
+    try:
+        with open(_url_file(url)) as f:
+            digest = f.read().strip()
+    except OSError:
+        return None
+
+    path = _object_file(digest)
+    if not os.path.exists(path):
+        return None
+    os.utime(path)  # Mark as recently used.
+    return path
+
+
+def fetch(url):
+    """Return a local file holding the content of a url.
+
+    The content is downloaded only if the url is not already cached. It
+    is kept from eviction until release() is called with the path.
+
+    :param url: The url of the image.
+    :return: The path of the cached file.
+    """
+    with _lock:
+        path = cached(url)
+        if path is not None:
+            _pinned[path] += 1
+    if path is not None:
+        timing.count("cache_hits")
+        return path
+
+    with timing.stage("download"):
+        data = download(url)
+    timing.count("downloads")
+    timing.count("bytes_downloaded", len(data))
+    digest = hashlib.sha256(data).hexdigest()
+    path = _object_file(digest)
+    with _lock:
+        _pinned[path] += 1
+    if not os.path.exists(path):
+        _write(path, data)
+        _grow(len(data))
+    _write(_url_file(url), digest.encode("ascii"))
+    return path
+
+
+def release(path):
+    """Let the content of a url be evicted again, once it has been read.
+
+    Paths not from fetch(), such as local images, are ignored.
+    """
+    with _lock:
+        if _pinned[path] > 1:
+            _pinned[path] -= 1
+        else:
+            _pinned.pop(path, None)
+
+
+def released(results, chunks):
+    """Yield the results of workers, releasing the files each was given.
+
+    :param results: The result for each chunk, in order.
+    :param chunks: The chunks of (path, file) from locate() the workers
+                   were given.
+    :return: A generator of the results.
+    """
+    for result, chunk in zip(results, chunks):
+        for _, imfile in chunk:
+            release(imfile)
+        yield result
+
+
+def _objects():
+    """List the (mtime, size, path) of every object in the cache.
+    """
+    root = cache_dir("downloads", "objects")
+    found = []
+    for sub in os.scandir(root):
+        if not sub.is_dir():
+            continue
+        for entry in os.scandir(sub.path):
+            stat = entry.stat()
+            found.append((stat.st_mtime, stat.st_size, entry.path))
+    return found
+
+
+def _grow(size):
+    """Account for new content, evicting old content when over the bound.
+    """
+    global _total
+    with _lock:
+        if _total is None:
+            _total = sum(size for _, size, _ in _objects())
+        else:
+            _total += size
+        if _total > CACHE_SIZE:
+            _total = evict(CACHE_SIZE)
+
+
+def evict(max_size=CACHE_SIZE):
+    """Remove the least recently used content until the cache fits.
+
+    Urls whose content has been removed are simply downloaded again.
+    Content still pinned by fetch() is kept.
+
+    :param max_size: The size in bytes to reduce the cache to.
+    :return: The size in bytes of the cache afterwards.
+    """
+    found = sorted(_objects())
+    total = sum(size for _, size, _ in found)
+    for _, size, path in found:
+        if total <= max_size:
+            break
+        if path in _pinned:
+            continue
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+    return total
+
+
+def locate(path):
+    """Return a local file for an image path or url, fetching urls.
+
+    Intended to be run across a pool of fetchers ahead of decoding.
+    Videos are left for OpenCV to read, including from urls. Call
+    release() with the local file once it has been read.
+
+    :param path: The path or url given on the command line.
+    :return: The path and its local file, or None if it could not be
+             downloaded.
+    """
+    if is_video(path) and urllib.parse.urlsplit(path).scheme:
+        return path, path
+    if not is_url(path):
+        return path, os.path.join(get_cmd_cwd(), path)
+
+    try:
+        return path, fetch(path)
+    except Exception as e:
+        sys.stderr.write(f"'{path}' could not be downloaded ({e}) " +
+                         f"and will be skipped.\n")
+        return path, None
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# Author: Graham.Williams@microsoft.com
+#
+# Cache the results of the models so that images already scored are not
+# scored again.
+#
+# Results are kept in SQLite, keyed by the SHA256 hash of the image's
+# content and by a fingerprint of the model, its weights, its settings
+# and the preprocessing (see zoo.fingerprint()). Renamed or re-fetched
+# copies of an image therefore share their results, while new weights
+# or a change to the preprocessing are scored afresh.
+#
+# From the Microsoft Best Practices Suite: Computer Vision
+# https://github.com/microsoft/ComputerVision
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from utils import cache_dir
+
+# The cache is bounded in size, with the least recently used results
+# evicted first. The bound is in bytes and may be set through the
+# environment.
+
+CACHE_SIZE = int(os.environ.get("CVBP_RESULT_CACHE_SIZE", 2**28))
+
+# The most likely classes kept for each image.
+
+TOP_K = 5
+
+
+def digest(path):
+    """Return the SHA256 hash of a file's content.
+    """
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def top_classes(prob, k=TOP_K):
+    """Return the k most likely classes as [probability, index] pairs.
+    """
+    values, indices = prob.topk(min(k, len(prob)))
+    return [[float(v), int(i)] for v, i in zip(values, indices)]
+
+
+class ResultCache:
+    """The results of the models on images, stored by content and model.
+
+    Each thread and process opens its own connection, so one cache can be
+    shared by prefetching threads and forked workers.
+    """
+
+    def __init__(self, path=None, max_size=CACHE_SIZE, refresh=False):
+        """
+        :param path: The SQLite file (default is results.sqlite in the cache).
+        :param max_size: The most bytes of results to keep.
+        :param refresh: Score every image again, replacing what is stored.
+        """
+        self.path = path or os.path.join(cache_dir("results"), "results.sqlite")
+        self.max_size = max_size
+        self.refresh = refresh
+        self.puts = 0
+        self._local = threading.local()
+
+    def _db(self):
+        db = getattr(self._local, "db", None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("CREATE TABLE IF NOT EXISTS results (" +
+                       "digest TEXT, model TEXT, value TEXT, size INTEGER, used REAL, " +
+                       "PRIMARY KEY (digest, model))")
+            db.execute("CREATE INDEX IF NOT EXISTS results_used ON results (used)")
+            self._local.db, self._local.pid = db, os.getpid()
+        return db
+
+    def get(self, digest, model):
+        """Return the stored result, or None if there is none.
+        """
+        if self.refresh:
+            return None
+        db = self._db()
+        row = db.execute("SELECT value FROM results WHERE digest = ? AND model = ?",
+                         (digest, model)).fetchone()
+        if row is None:
+            return None
+        db.execute("UPDATE results SET used = ? WHERE digest = ? AND model = ?",
+                   (time.time(), digest, model))
+        return json.loads(row[0])
+
+    def get_many(self, digest, models):
+        """Return the stored results of several models.
+
+        :param models: A dict of names to model fingerprints.
+        :return: A dict of the names with a stored result to the result.
+        """
+        found = {}
+        for name, model in models.items():
+            value = self.get(digest, model)
+            if value is not None:
+                found[name] = value
+        return found
+
+    def put(self, digest, model, value):
+        """Store a result, evicting the least recently used now and then.
+
+        :param value: The result, anything JSON can hold.
+        """
+        text = json.dumps(value, default=lambda o: o.item())  # numpy scalars.
+        self._db().execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                           (digest, model, text, len(digest) + len(model) + len(text),
+                            time.time()))
+        self.puts += 1
+        if self.puts % 1000 == 1:
+            self.evict()
+
+    def evict(self, max_size=None):
+        """Remove the least recently used results beyond the size limit.
+
+        :return: The size of the results kept, in bytes.
+        """
+        max_size = self.max_size if max_size is None else max_size
+        db = self._db()
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        excess = total - max_size
+        if excess <= 0:
+            return total
+
+        for used, size in db.execute("SELECT used, size FROM results ORDER BY used"):
+            excess -= size
+            if excess <= 0:
+                break
+        db.execute("DELETE FROM results WHERE used <= ?", (used,))
+        return db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# Author: Graham.Williams@microsoft.com
+#
+# Group single inference requests from many callers into batches.
+#
+# From the Microsoft Best Practices Suite: Computer Vision
+# https://github.com/microsoft/ComputerVision
+
+import math
+import threading
+import time
+
+from concurrent.futures import Future
+
+
+def aspect_bucket(im):
+    """Bucket a PIL image by its aspect ratio, in steps of a quarter octave.
+
+    The detector resizes each image to a common scale and pads the batch
+    to the largest, so images of a similar shape batch with little
+    wasted padding.
+    """
+    width, height = im.size
+    return round(4 * math.log2(width / height))
+
+
+class Batcher:
+    """Run a batch function over items submitted one at a time.
+
+    Items from any number of threads are collected until there are
+    max_batch of them or the first has waited max_wait seconds, and are
+    then passed together to func, which returns one result per item.
+    Each caller receives its own result through a future.
+
+    With a key function items are only batched with others of the same
+    key, such as images of a similar size.
+    """
+
+    def __init__(self, func, max_batch=16, max_wait=0.005, key=None):
+        self.func = func
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.key = key
+        self.cond = threading.Condition()
+        self.pending = {}  # Key to a list of (time, item, future).
+        self.closed = False
+
+        self.depth = 0
+        self.batches = 0
+        self.items = 0
+        self.waited = 0.0
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, item):
+        """Queue an item, returning the future of its result.
+        """
+        future = Future()
+        key = None if self.key is None else self.key(item)
+        with self.cond:
+            if self.closed:
+                raise RuntimeError("The batcher has been closed.")
+            self.pending.setdefault(key, []).append((time.monotonic(), item, future))
+            self.depth += 1
+            self.cond.notify()
+        return future
+
+    def close(self):
+        """Finish the queued items and stop.
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
+
+    def metrics(self):
+        """Return the queue depth and how well batches have been filled.
+        """
+        with self.cond:
+            batches = max(self.batches, 1)
+            return {
+                "queue_depth": self.depth,
+                "batches": self.batches,
+                "items": self.items,
+                "mean_batch_size": self.items / batches,
+                "batch_fill": self.items / batches / self.max_batch,
+                "mean_wait": self.waited / max(self.items, 1),
+            }
+
+    def _collect(self):
+        """Wait for the next batch, or None once closed and drained.
+
+        A key is ready when it has a full batch, its oldest item has
+        waited long enough, or the batcher is closing. Of those ready
+        the one waiting longest goes first.
+        """
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                ready = wake = None  # The (since, key) of the oldest ready.
+                for key, queued in self.pending.items():
+                    since = queued[0][0]
+                    if len(queued) >= self.max_batch or \
+                       self.closed or now - since >= self.max_wait:
+                        if ready is None or since < ready[0]:
+                            ready = (since, key)
+                    elif wake is None or since + self.max_wait < wake:
+                        wake = since + self.max_wait
+
+                if ready is not None:
+                    _, ready = ready
+                    queued = self.pending[ready]
+                    batch = queued[:self.max_batch]
+                    if len(queued) > self.max_batch:
+                        self.pending[ready] = queued[self.max_batch:]
+                    else:
+                        del self.pending[ready]
+                    self.depth -= len(batch)
+                    self.batches += 1
+                    self.items += len(batch)
+                    self.waited += sum(now - since for since, _, _ in batch)
+                    return batch
+
+                if self.closed:
+                    return None
+                self.cond.wait(None if wake is None else wake - now)
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                break
+
+            _, items, futures = zip(*batch)
+            try:
+                results = self.func(list(items))
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            for future, result in zip(futures, results):
+                future.set_result(result)
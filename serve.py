@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# Author: Graham.Williams@microsoft.com
+#
+# A long running server that loads the models once and then classifies
+# or detects objects in images on request. While it is running the
+# classify and detect commands forward to it.
+#
+# ml serve cvbp [--model=<name>] [--port=<port>]
+#
+# POST /classify or /detect with either a JSON body {"paths": [...],
+# "models": [...], "format": "csv"|"json"} or the bytes of an image
+# (with ?model=&format=&name= in the url). GET /health lists the models
+# and GET /metrics reports the queue depth and batch fill of each.
+#
+# From the Microsoft Best Practices Suite: Computer Vision
+# https://github.com/microsoft/ComputerVision
+
+# ----------------------------------------------------------------------
+# Setup.
+# ----------------------------------------------------------------------
+
+# Required libraries.
+
+import utils
+
+import io
+import os
+import sys
+import json
+import argparse
+import urllib.parse
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+
+from fastai.vision import open_image
+from PIL import Image
+
+from utils_cv.detection.data import coco_labels
+from utils_cv.detection.model import DetectionLearner
+
+from client import endpoint
+from fetch import locate, release
+from scheduler import Batcher, aspect_bucket
+from zoo import all_models, backends, get_model, imagenet_classes
+from zoo import detectors, profiles, build_detector
+from zoo import prepare_image, image_batch, predict_batch, detect_batch
+
+# ----------------------------------------------------------------------
+# Parse command line arguments: --model= --task= --port=
+# ----------------------------------------------------------------------
+
+options = argparse.ArgumentParser(
+    prog='serve',
+    description='Serve classification and detection requests.'
+)
+
+options.add_argument(
+    '-m', '--model',
+    default="resnet152",
+    help="comma separated models to serve, or all (default is resnet152)")
+
+options.add_argument(
+    '--backend',
+    choices=backends,
+    default="eager",
+    help="run the models eagerly or compiled (default is eager)")
+
+options.add_argument(
+    '--detector',
+    choices=detectors,
+    default="fasterrcnn_resnet50_fpn",
+    help="detection model to serve (default is fasterrcnn_resnet50_fpn)")
+
+options.add_argument(
+    '--profile',
+    choices=profiles,
+    default="realtime",
+    help="detection speed and accuracy profile (default is realtime)")
+
+options.add_argument(
+    '--task',
+    choices=["classify", "detect", "both"],
+    default="both",
+    help="which commands to serve (default is both)")
+
+options.add_argument(
+    '-p', '--port',
+    type=int,
+    help="listen on this localhost port (default is a Unix socket)")
+
+options.add_argument(
+    '-b', '--batch-size',
+    type=int,
+    default=16,
+    help="most images per forward pass (default is 16)")
+
+options.add_argument(
+    '--max-wait',
+    type=float,
+    default=0.005,
+    help="seconds to wait to fill a batch (default is 0.005)")
+
+options.add_argument(
+    '--workers',
+    type=int,
+    default=4,
+    help="threads to decode the images of each request (default is 4)")
+
+args = options.parse_args()
+
+if args.model == "all":
+    modeln = list(all_models)
+else:
+    modeln = args.model.split(",")
+
+for m in modeln:
+    if m not in all_models:
+        sys.stderr.write(f"Selected model '{m}' is not known.\n")
+        sys.exit(1)
+
+# ----------------------------------------------------------------------
+# Load the models once, each behind a batcher.
+# ----------------------------------------------------------------------
+
+classifiers = {}
+detector = None
+
+if args.task in ("classify", "both"):
+    labels = imagenet_classes()
+    for m in modeln:
+        model = get_model(m, args.backend)
+        classifiers[m] = Batcher(
+            lambda xs, model=model: list(predict_batch(model, image_batch(xs))),
+            args.batch_size, args.max_wait)
+
+if args.task in ("detect", "both"):
+    model = build_detector(args.detector, args.profile)
+    learner = DetectionLearner(model=model, labels=coco_labels()[1:])
+    detector = Batcher(lambda ims: detect_batch(learner, ims),
+                       args.batch_size, args.max_wait, key=aspect_bucket)
+
+# ----------------------------------------------------------------------
+# Handle requests
+# ----------------------------------------------------------------------
+
+def load(task, item):
+    """Decode and prepare an image for a task, or None if it is not one.
+    """
+    name, src = item
+    if isinstance(src, str):
+        src = locate(src)[1]  # Urls through the download cache.
+    if src is None:
+        return name, None
+
+    try:
+        if task == "classify":
+            return name, prepare_image(open_image(src, convert_mode='RGB'))
+        return name, Image.open(src).convert('RGB')
+    except:
+        sys.stderr.write(f"'{name}' may not be an image file and will be skipped.\n")
+        return name, None
+    finally:
+        release(src)
+
+
+def classify(images, models):
+    """Return rows of (prob, label, model, name) for the images.
+    """
+    pending = [(name, [(m, classifiers[m].submit(x)) for m in models])
+               for name, x in images if x is not None]
+    rows = []
+    for name, futures in pending:
+        for m, future in futures:
+            prob = future.result()
+            ind = prob.argmax()
+            rows.append((float(prob[ind]), labels[ind], m, name))
+    return rows
+
+
+def detect(images):
+    """Return rows of (score, label, left, top, right, bottom, name).
+    """
+    pending = [(name, detector.submit(im)) for name, im in images if im is not None]
+    return [(float(a.score), a.label_name, a.left, a.top, a.right, a.bottom, name)
+            for name, future in pending for a in future.result()]
+
+
+def format_rows(task, rows, fmt):
+    if fmt == "json":
+        keys = (("prob", "label", "model", "path") if task == "classify" else
+                ("score", "label", "left", "top", "right", "bottom", "path"))
+        return json.dumps([dict(zip(keys, r)) for r in rows]) + "\n"
+    if task == "classify":
+        return "".join(f"{r[0]:.2f},{r[1]},{r[2]},{r[3]}\n" for r in rows)
+    return "".join(f"{r[0]:.2f},{r[1]},{r[2]},{r[3]},{r[4]},{r[5]},{r[6]}\n"
+                   for r in rows)
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def reply(self, status, text, content_type="text/plain"):
+        data = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/health":
+            status = {"classify": list(classifiers), "backend": args.backend,
+                      "detect": detector is not None,
+                      "detector": detector and [args.detector, args.profile]}
+        elif self.path == "/metrics":
+            status = {m: b.metrics() for m, b in classifiers.items()}
+            if detector is not None:
+                status["detect"] = detector.metrics()
+        else:
+            return self.reply(404, "Not found.\n")
+        self.reply(200, json.dumps(status) + "\n", "application/json")
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        task = url.path.strip("/")
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        if task == "classify" and not classifiers or \
+           task == "detect" and detector is None or \
+           task not in ("classify", "detect"):
+            return self.reply(404, f"The server does not {task}.\n")
+
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            request = json.loads(body)
+            paths = request["paths"]
+            names = request.get("names") or paths
+            models = request.get("models")
+            fmt = request.get("format", "csv")
+            items = zip(names, paths)
+        else:
+            models = query["model"].split(",") if "model" in query else None
+            fmt = query.get("format", "csv")
+            items = [(query.get("name", "-"), io.BytesIO(body))]
+
+        models = models or list(classifiers)
+        unknown = [m for m in models if m not in classifiers]
+        if task == "classify" and unknown:
+            return self.reply(400, f"The server does not have '{unknown[0]}'.\n")
+
+        images = utils.prefetch(lambda item: load(task, item), items, args.workers)
+        rows = classify(images, models) if task == "classify" else detect(images)
+        self.reply(200, format_rows(task, rows, fmt),
+                   "application/json" if fmt == "json" else "text/csv")
+
+    def log_message(self, format, *args):
+        pass  # Keep the server quiet.
+
+
+class UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+# ----------------------------------------------------------------------
+# Run the server
+# ----------------------------------------------------------------------
+
+where = endpoint()
+if args.port is None and where.startswith("http://"):
+    args.port = urllib.parse.urlsplit(where).port
+
+if args.port is not None:
+    server = ThreadingHTTPServer(("localhost", args.port), Handler)
+    where = f"http://localhost:{args.port}"
+else:
+    os.makedirs(os.path.dirname(where), exist_ok=True)
+    if os.path.exists(where):
+        os.remove(where)  # A stale socket from an earlier server.
+    server = UnixHTTPServer(where, Handler)
+
+sys.stderr.write(f"Serving at {where}. Press Ctrl-C to stop.\n")
+if args.port is not None:
+    sys.stderr.write(f"Set CVBP_SERVER={where} for commands to use it.\n")
+
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    pass
+finally:
+    server.server_close()
+    if args.port is None:
+        os.remove(where)
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+#
+# The helpers for detected boxes.
+
+import pytest
+
+from detection import ios, iou, mean_average_precision, merge_tiles, nms, tiles
+
+
+def test_overlap():
+    assert iou((0, 0, 10, 10), (0, 0, 10, 10)) == 1.0
+    assert iou((0, 0, 10, 10), (10, 0, 20, 10)) == 0.0
+    assert iou((0, 0, 10, 10), (5, 0, 15, 10)) == pytest.approx(1 / 3)
+    assert ios((0, 0, 10, 10), (2, 2, 4, 4)) == 1.0
+
+
+def test_nms():
+    found = [(0.6, "cat", (1, 1, 11, 11)),
+             (0.9, "cat", (0, 0, 10, 10)),
+             (0.8, "dog", (0, 0, 10, 10)),
+             (0.7, "cat", (50, 50, 60, 60))]
+    assert nms(found) == [(0.9, "cat", (0, 0, 10, 10)),
+                          (0.8, "dog", (0, 0, 10, 10)),
+                          (0.7, "cat", (50, 50, 60, 60))]
+
+
+def test_tiles_cover():
+    found = tiles(2500, 1000, 1024, 768)
+    assert all(right - left == 1024 for left, _, right, _ in found)
+    assert {left for left, _, _, _ in found} == {0, 768, 1476}
+    assert {(top, bottom) for _, top, _, bottom in found} == {(0, 1000)}
+    assert tiles(500, 400, 1024, 768) == [(0, 0, 500, 400)]
+
+
+def test_merge_tiles():
+    left, right = (0, 0, 1024, 1000), (768, 0, 1792, 1000)
+
+    # A person partly in front of another, both from one tile.
+    behind, front = (100, 100, 300, 500), (150, 150, 250, 400)
+    found = [(0.9, "person", behind, left), (0.8, "person", front, left)]
+    assert merge_tiles(found, 2000, 1000) == [(0.9, "person", behind),
+                                              (0.8, "person", front)]
+
+    # An object cut short at a seam, and whole in the next tile.
+    whole, cut = (900, 100, 1100, 400), (900, 100, 1024, 400)
+    found = [(0.95, "car", cut, left), (0.9, "car", whole, right)]
+    assert merge_tiles(found, 2000, 1000) == [(0.9, "car", whole)]
+
+
+def test_mean_average_precision():
+    truth = [[("cat", (0, 0, 10, 10))], [("dog", (0, 0, 10, 10))]]
+    exact = [[(0.9, label, box) for label, box in refs] for refs in truth]
+    assert mean_average_precision(exact, truth) == 1.0
+
+    missed = [exact[0], [(0.9, "dog", (50, 50, 60, 60))]]
+    assert mean_average_precision(missed, truth) == 0.5
+    assert mean_average_precision(exact, [[], []]) is None
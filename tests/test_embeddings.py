@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+#
+# The embedding index, its recovery and its search.
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import embeddings
+
+from embeddings import EmbeddingIndex
+
+
+def vectors(n, dim=32, seed=0):
+    x = np.random.default_rng(seed).normal(size=(n, dim)).astype(np.float32)
+    return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+
+def test_recover_interrupted_rows(tmp_path):
+    index = EmbeddingIndex(str(tmp_path), "resnet50", "fp", 32)
+    x = vectors(5)
+    index.add([f"{i}.jpg" for i in range(5)], x)
+    index.files["vectors.f16"].write(b"\0" * 10)  # Part of a row.
+    index.path_file.write("5.j")  # Part of a path.
+    index.close()
+
+    index = EmbeddingIndex(str(tmp_path), "resnet50", "fp", 32)
+    assert len(index) == 5
+    assert index.known == {f"{i}.jpg" for i in range(5)}
+    assert index.search(x[3], k=1)[0][1] == "3.jpg"
+    index.close()
+
+
+def test_other_weights_refused(tmp_path):
+    EmbeddingIndex(str(tmp_path), "resnet50", "fp", 32).close()
+    with pytest.raises(ValueError):
+        EmbeddingIndex(str(tmp_path), "resnet50", "other", 32)
+
+
+def test_approximate_search(tmp_path, monkeypatch):
+    monkeypatch.setattr(embeddings, "TRAIN_SIZE", 200)
+    monkeypatch.setattr(embeddings, "CELLS", 8)
+    monkeypatch.setattr(embeddings, "CENTROIDS", 16)
+
+    index = EmbeddingIndex(str(tmp_path), "resnet50", "fp", 32)
+    x = vectors(300)
+    index.add([f"{i}.jpg" for i in range(200)], x[:200])
+    assert index.trained
+    index.add([f"{i}.jpg" for i in range(200, 300)], x[200:])
+    index.close()
+
+    index = EmbeddingIndex(str(tmp_path), "resnet50", "fp", 32)
+    for i in (7, 250):
+        assert index.search(x[i], k=1, nprobe=8)[0][1] == f"{i}.jpg"
+        assert index.search(x[i], k=1, exact=True)[0][1] == f"{i}.jpg"
+    index.close()
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+#
+# The download cache, against a local http.server.
+
+import os
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("mlhub")
+pytest.importorskip("cv2")
+
+CONTENT = {"/a.jpg": b"first image", "/b.jpg": b"second image"}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep connections alive, as fetch does.
+    hits = []
+
+    def do_GET(self):
+        self.hits.append(self.path)
+        if self.path == "/moved":
+            self.send_response(302)
+            self.send_header("Location", "/a.jpg")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = CONTENT.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    monkeypatch.setenv("CVBP_CACHE", str(tmp_path))
+    Handler.hits = []
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_port}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_cache_hit(server):
+    import fetch
+
+    first = fetch.fetch(server + "/a.jpg")
+    again = fetch.fetch(server + "/a.jpg")
+    assert first == again
+    assert read(first) == CONTENT["/a.jpg"]
+    assert Handler.hits == ["/a.jpg"]
+    fetch.release(first)
+    fetch.release(again)
+
+
+def test_redirect(server):
+    import fetch
+
+    path = fetch.fetch(server + "/moved")
+    assert read(path) == CONTENT["/a.jpg"]
+    assert Handler.hits == ["/moved", "/a.jpg"]
+    fetch.release(path)
+
+
+def test_pinned_not_evicted(server):
+    import fetch
+
+    a = fetch.fetch(server + "/a.jpg")
+    b = fetch.fetch(server + "/b.jpg")
+    fetch.release(b)
+    fetch.evict(0)
+    assert os.path.exists(a)
+    assert not os.path.exists(b)
+
+    fetch.release(a)
+    assert fetch.evict(0) == 0
+    assert not os.path.exists(a)
+    assert fetch.cached(server + "/a.jpg") is None
+
+
+def test_release_local_file(server):
+    import fetch
+
+    fetch.release("not/fetched.jpg")  # Ignored.
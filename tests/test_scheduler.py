@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+#
+# Batching single requests.
+
+from types import SimpleNamespace
+
+import pytest
+
+from scheduler import Batcher, aspect_bucket
+
+
+def test_batches():
+    sizes = []
+
+    def double(items):
+        sizes.append(len(items))
+        return [2 * x for x in items]
+
+    batcher = Batcher(double, max_batch=4, max_wait=1.0)
+    futures = [batcher.submit(x) for x in range(10)]
+    batcher.close()
+    assert [f.result() for f in futures] == [2 * x for x in range(10)]
+    assert sizes == [4, 4, 2]
+    assert batcher.metrics()["items"] == 10
+
+
+def test_keys_batched_apart():
+    batches = []
+
+    def record(items):
+        batches.append(items)
+        return items
+
+    batcher = Batcher(record, max_batch=8, max_wait=1.0, key=lambda x: x % 2)
+    futures = [batcher.submit(x) for x in range(6)]
+    batcher.close()
+    assert [f.result() for f in futures] == list(range(6))
+    assert sorted(batches) == [[0, 2, 4], [1, 3, 5]]
+
+
+def test_errors_reach_callers():
+    def fail(items):
+        raise ValueError("bad batch")
+
+    batcher = Batcher(fail, max_wait=0)
+    future = batcher.submit(1)
+    with pytest.raises(ValueError):
+        future.result(timeout=5)
+    batcher.close()
+    with pytest.raises(RuntimeError):
+        batcher.submit(2)
+
+
+def test_aspect_bucket():
+    assert aspect_bucket(SimpleNamespace(size=(640, 480))) == \
+        aspect_bucket(SimpleNamespace(size=(800, 600)))
+    assert aspect_bucket(SimpleNamespace(size=(480, 640))) < 0
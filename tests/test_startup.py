@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+#
+# The light commands start without loading torch, fastai or matplotlib,
+# as `ml benchmark cvbp --startup` measures by hand.
+
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+BUDGET = 1.0  # Seconds, as the default of benchmark --budget.
+REPEAT = 3
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY = ("torch", "torchvision", "fastai", "matplotlib", "cv2", "onnxruntime")
+
+commands = [
+    ["classify.py", "--model=list"],
+    ["detect.py", "--model=list"],
+    ["detect.py", "--help"],
+    ["embed.py", "--model=list"],
+    ["benchmark.py", "--help"],
+]
+
+
+@pytest.mark.parametrize("command", commands, ids=" ".join)
+def test_startup(command, tmp_path):
+    env = dict(os.environ, CVBP_SERVER=str(tmp_path / "no-server.sock"))
+    times = []
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        done = subprocess.run([sys.executable, "-X", "importtime"] + command,
+                              cwd=HERE, env=env, capture_output=True, text=True)
+        times.append(time.perf_counter() - start)
+        assert done.returncode == 0, done.stderr
+
+    imported = {line.split("|")[-1].strip() for line in done.stderr.splitlines()
+                if line.startswith("import time:")}
+    assert not imported & set(HEAVY)
+    assert min(times) < BUDGET
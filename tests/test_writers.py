@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+#
+# Resuming interrupted output.
+
+import json
+import sqlite3
+
+import pytest
+
+pytest.importorskip("mlhub")
+pytest.importorskip("cv2")
+
+import corpus
+import writers
+
+columns = [("score", "float", ".2f"), ("label", "str", "s"), ("path", "str", "s")]
+
+
+@pytest.fixture(autouse=True)
+def cwd(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr("mlhub.utils.get_cmd_cwd", lambda: str(tmp_path))
+    monkeypatch.setattr(corpus, "get_cmd_cwd", lambda: str(tmp_path))
+
+
+def rows(path, n=1):
+    return [{"score": 0.5, "label": "cat", "path": path}] * n
+
+
+def test_checkpoint_resume(tmp_path):
+    checkpoint = corpus.Checkpoint("out.csv")
+    checkpoint.write("a.jpg", "a\n")
+    checkpoint.write("b.jpg", "b\n")
+    checkpoint.write("c.jpg", "c-part")  # Interrupted before c completes.
+    checkpoint.out.flush()
+
+    resumed = corpus.Checkpoint("out.csv")
+    assert resumed.done == {"a.jpg", "b.jpg"}
+    resumed.write("c.jpg", "c\n")
+    resumed.close()
+    assert (tmp_path / "out.csv").read_text() == "a\nb\nc\n"
+
+
+def test_sqlite_resume(tmp_path):
+    writer = writers.SqliteWriter("out.db", columns, rows=2)
+    for path in ("a.jpg", "b.jpg", "c.jpg"):
+        writer.write(path, rows(path))
+    writer.write("empty.jpg", [])
+    writer.write("d.jpg", rows("d.jpg"))  # Completes empty.jpg, flushing.
+    writer.db.close()  # Interrupted while d.jpg is pending.
+
+    resumed = writers.SqliteWriter("out.db", columns, rows=2)
+    assert resumed.done == {"a.jpg", "b.jpg", "c.jpg", "empty.jpg"}
+    resumed.write("d.jpg", rows("d.jpg"))
+    resumed.close()
+    db = sqlite3.connect(str(tmp_path / "out.db"))
+    assert sorted(p for p, in db.execute("SELECT path FROM results")) == \
+        ["a.jpg", "b.jpg", "c.jpg", "d.jpg"]
+
+
+def test_parquet_resume(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+
+    writer = writers.ParquetWriter("out", columns, rows=2)
+    for path in ("a.jpg", "b.jpg", "c.jpg", "d.jpg"):
+        writer.write(path, rows(path))  # c.jpg writes a and b as a part.
+    (tmp_path / "out" / "part-00001.parquet.tmp").write_bytes(b"cut short")
+
+    resumed = writers.ParquetWriter("out", columns, rows=2)
+    assert resumed.done == {"a.jpg", "b.jpg"}
+    for path in ("c.jpg", "d.jpg"):
+        resumed.write(path, rows(path))
+    resumed.close()
+    table = pq.read_table(str(tmp_path / "out"))
+    assert sorted(table.column("path").to_pylist()) == ["a.jpg", "b.jpg", "c.jpg", "d.jpg"]
+
+
+def test_json_line():
+    line = writers.json_line(columns, {"score": 0.5, "label": "cat", "path": "a.jpg"})
+    assert json.loads(line) == {"score": 0.5, "label": "cat", "path": "a.jpg"}
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# Author: Graham.Williams@microsoft.com
+#
+# Opt-in timers and counters for the stages of a run, to tell whether
+# the time goes to importing, loading weights, downloading, decoding,
+# preprocessing, the forward pass or writing the output.
+#
+# CVBP_PROFILE=1      time the stages and print a table on exit
+# CVBP_PROFILE=torch  also run the torch profiler around forward passes
+# CVBP_TRACE=<file>   also write a Chrome trace (chrome://tracing)
+#
+# From the Microsoft Best Practices Suite: Computer Vision
+# https://github.com/microsoft/ComputerVision
+
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+
+from collections import Counter, defaultdict
+from contextlib import contextmanager, nullcontext
+
+started = time.perf_counter()  # About when the command started.
+
+mode = os.environ.get("CVBP_PROFILE", "").lower()
+trace = os.environ.get("CVBP_TRACE") or None
+enabled = mode not in ("", "0", "false", "no") or trace is not None
+
+calls = Counter()
+totals = defaultdict(float)
+counters = Counter()
+operators = defaultdict(float)  # Self CPU microseconds of torch operators.
+events = []
+
+_lock = threading.Lock()
+_disabled = nullcontext()
+
+
+def record(name, start, end=None):
+    """Record a stage that ran from start to end, both perf_counter().
+    """
+    if not enabled:
+        return
+    end = time.perf_counter() if end is None else end
+    with _lock:
+        calls[name] += 1
+        totals[name] += end - start
+        if trace is not None:
+            events.append({
+                "name": name, "ph": "X", "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "ts": round(1e6 * (start - started), 1),
+                "dur": round(1e6 * (end - start), 1),
+            })
+
+
+@contextmanager
+def _stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, start)
+
+
+def stage(name):
+    """Time the enclosed block as one call of the named stage.
+
+    When profiling is off this is a shared no-op context.
+    """
+    return _stage(name) if enabled else _disabled
+
+
+def count(name, n=1):
+    """Add n to the named counter, such as bytes downloaded."""
+    if enabled:
+        with _lock:
+            counters[name] += n
+
+
+@contextmanager
+def _forward():
+    import torch
+
+    with _stage("forward"), torch.profiler.profile() as prof:
+        yield
+    averages = prof.key_averages()
+    with _lock:
+        for op in averages:
+            operators[op.key] += op.self_cpu_time_total
+
+
+def forward():
+    """Time the enclosed forward pass, under the torch profiler if asked.
+    """
+    if not enabled:
+        return _disabled
+    return _forward() if mode == "torch" else _stage("forward")
+
+
+def take():
+    """Return what has been recorded so far, and start again from nothing.
+
+    Forked workers exit without running the report, so they send what
+    they take back to the parent to merge().
+    """
+    with _lock:
+        taken = (dict(calls), dict(totals), dict(counters), dict(operators), list(events))
+        for recorded in (calls, totals, counters, operators, events):
+            recorded.clear()
+    return taken
+
+
+def merge(taken):
+    """Add what another process took to what has been recorded here.
+    """
+    more_calls, more_totals, more_counters, more_operators, more_events = taken
+    with _lock:
+        calls.update(more_calls)
+        counters.update(more_counters)
+        for name, total in more_totals.items():
+            totals[name] += total
+        for name, micros in more_operators.items():
+            operators[name] += micros
+        events.extend(more_events)
+
+
+def report():
+    """Print the stages and counters, and write the trace, at exit.
+
+    The stages of forked workers are included, so that with --procs
+    their totals can add up to more than the time of the run.
+    """
+    if not enabled or not (calls or counters):
+        return
+    sys.stderr.write(f"{'stage':<16} {'calls':>7} {'total_s':>9} {'mean_ms':>9}\n")
+    for name, total in sorted(totals.items(), key=lambda kv: -kv[1]):
+        sys.stderr.write(f"{name:<16} {calls[name]:>7} {total:>9.3f} " +
+                         f"{1000 * total / calls[name]:>9.2f}\n")
+    for name, n in sorted(counters.items()):
+        sys.stderr.write(f"{name:<16} {n:>7}\n")
+    for name, micros in sorted(operators.items(), key=lambda kv: -kv[1])[:15]:
+        sys.stderr.write(f"{name:<30} {micros / 1e6:>9.3f}\n")
+
+    if trace is not None:
+        counts = [{"name": name, "ph": "C", "pid": os.getpid(),
+                   "ts": round(1e6 * (time.perf_counter() - started), 1),
+                   "args": {name: n}} for name, n in counters.items()]
+        with open(trace, "w") as f:
+            json.dump({"traceEvents": events + counts}, f)
+
+
+atexit.register(report)
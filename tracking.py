@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# Author: Graham.Williams@microsoft.com
+#
+# Follow detected objects from frame to frame of a video or webcam.
+#
+# The detector is run only on keyframes, every so many frames or when
+# the scene changes. In between, each box is moved by the median optical
+# flow of the corners found within it, which costs a few milliseconds
+# rather than the detector's second or so on a CPU. Detections on a
+# keyframe are matched to the boxes followed so far by their overlap so
+# that each object keeps its track number.
+#
+# From the Microsoft Best Practices Suite: Computer Vision
+# https://github.com/microsoft/ComputerVision
+
+import cv2 as cv
+import numpy as np
+
+from detection import iou
+from utils import FrameRate
+
+TEXT_COLOR = (0, 255, 0)  # Green
+TEXT_FONT = cv.FONT_HERSHEY_SIMPLEX
+
+
+class Tracker:
+    """Detect objects on keyframes and follow them in the frames between.
+
+    Called with each OpenCV frame in turn, it returns the tracks in the
+    frame as (track, score, label, left, top, right, bottom), where the
+    score and label are from the keyframe the object was last detected
+    on.
+    """
+
+    def __init__(self, detect, every=10, scene_change=0.3, overlap=0.3):
+        """
+        :param detect: Returns the (score, label, left, top, right, bottom)
+                       of the objects in an OpenCV frame.
+        :param every: Run the detector on every Nth frame, 1 for all.
+        :param scene_change: The Bhattacharyya distance between the grey
+                             level histograms of consecutive frames taken
+                             as a new scene, also run the detector.
+        :param overlap: The least IoU of a detection with a track for it
+                        to continue that track.
+        """
+        self.detect = detect
+        self.every = every
+        self.scene_change = scene_change
+        self.overlap = overlap
+
+        self.tracks = []  # [track, score, label, box as float array]
+        self.next_track = 1
+        self.since = 0  # Frames since the last keyframe.
+        self.frames = FrameRate()
+        self.keyframes = FrameRate()
+        self.gray = self.hist = None
+
+    def __call__(self, frame):
+        gray = cv.cvtColor(frame, cv.COLOR_BGR2GRAY)
+        hist = cv.calcHist([cv.resize(gray, (64, 48))], [0], None, [32], [0, 256])
+        cv.normalize(hist, hist)
+
+        changed = self.hist is not None and self.scene_change and \
+            cv.compareHist(self.hist, hist, cv.HISTCMP_BHATTACHARYYA) > self.scene_change
+        if self.gray is None or self.since + 1 >= self.every or changed:
+            self._keyframe(frame)
+        else:
+            self._follow(self.gray, gray)
+            self.since += 1
+
+        self.gray, self.hist = gray, hist
+        self.frames.tick()
+        return [(track, score, label, *map(int, box))
+                for track, score, label, box in self.tracks]
+
+    def _keyframe(self, frame):
+        """Detect the objects, continuing the tracks they overlap.
+        """
+        found = self.detect(frame)
+        pairs = sorted(
+            ((iou(box, tuple(t[3])), i, j)
+             for i, (_, label, *box) in enumerate(found)
+             for j, t in enumerate(self.tracks) if t[2] == label),
+            reverse=True)
+
+        matched, used, tracks = {}, set(), []
+        for overlap, i, j in pairs:
+            if overlap < self.overlap:
+                break
+            if i not in matched and j not in used:
+                matched[i] = self.tracks[j][0]
+                used.add(j)
+
+        for i, (score, label, *box) in enumerate(found):
+            track = matched.get(i)
+            if track is None:
+                track, self.next_track = self.next_track, self.next_track + 1
+            tracks.append([track, score, label, np.array(box, dtype=np.float32)])
+
+        self.tracks = tracks
+        self.since = 0
+        self.keyframes.tick()
+
+    def _follow(self, before, after):
+        """Move each box by the median flow of the corners within it.
+        """
+        height, width = after.shape
+        starts, owners = [], []
+        for n, (_, _, _, box) in enumerate(self.tracks):
+            left, top, right, bottom = np.clip(box, 0, [width, height, width, height]).astype(int)
+            if right - left < 4 or bottom - top < 4:
+                continue
+            corners = cv.goodFeaturesToTrack(before[top:bottom, left:right], 20, 0.01, 3)
+            if corners is None:
+                continue
+            starts.append(corners.reshape(-1, 2) + (left, top))
+            owners += [n] * len(corners)
+        if not len(starts):
+            return
+
+        starts = np.concatenate(starts).astype(np.float32)
+        ends, status, _ = cv.calcOpticalFlowPyrLK(before, after, starts, None)
+        owners = np.array(owners)
+        moved = (ends - starts)[status.ravel() == 1]
+        owners = owners[status.ravel() == 1]
+        for n in set(owners):
+            dx, dy = np.median(moved[owners == n], axis=0)
+            self.tracks[n][3] += (dx, dy, dx, dy)
+
+    def report(self):
+        """Return the frame and keyframe rates as a line of text.
+        """
+        return (f"{self.frames.count} frames at {self.frames.fps():.1f} fps, " +
+                f"{self.keyframes.count} keyframes at {self.keyframes.fps():.1f} fps")
+
+
+def draw_tracks(frame, tracks):
+    """Draw the tracks onto an OpenCV frame, labelled by track number.
+    """
+    for track, score, label, left, top, right, bottom in tracks:
+        cv.rectangle(frame, (left, top), (right, bottom), TEXT_COLOR, 2)
+        cv.putText(frame, f"{label} {track}", (left, max(top - 5, 10)),
+                   TEXT_FONT, 0.5, TEXT_COLOR, 1)
+    return frame
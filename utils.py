@@ -1,25 +1,43 @@
 import cv2 as cv
-import matplotlib.pyplot as plt
 import numpy as np
+import os
 import PIL
 import sys
+import threading
+import time
+import timing
 
-from matplotlib.animation import FuncAnimation
-from torchvision import transforms as T
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from queue import Queue
+from urllib.parse import urlsplit
+
+# torch and matplotlib are imported only by the functions needing them,
+# so that listing models or forwarding to a server does not load them.
 
 TEXT_COLOR = (0, 255, 0)  # Green
 LINE_WIDTH = 2
 TEXT_FONT = cv.FONT_HERSHEY_SIMPLEX
 TEXT_SIZE = 0.75
 
+VIDEO_EXTENSIONS = {".avi", ".m4v", ".mkv", ".mov", ".mp4", ".mpeg", ".mpg", ".webm", ".wmv"}
+STREAM_SCHEMES = {"rtsp", "rtmp", "udp", "tcp"}
+
+# The number of image copies made by the conversions below, by function,
+# so that any copying left on the path of a frame can be seen.
+
+copies = Counter()
+
 
 def get_camera(num=0):
     """Get the camera.
 
     :param num:  The camera number.  By default the first camera will be returned.
+                 A video file or stream url may be given instead.
     :return: The camera used by OpenCV.
     """
-    capture = cv.VideoCapture(int(num))
+    capture = cv.VideoCapture(int(num) if str(num).isdigit() else num)
     if not capture.isOpened():
         print('Unable to load camera!')
         sys.exit(1)
@@ -27,43 +45,292 @@ def get_camera(num=0):
     return capture
 
 
+def cache_dir(*parts):
+    """Return a directory within the package's local cache, creating it.
+
+    The cache lives in ~/.cache/cvbp unless CVBP_CACHE is set.
+
+    :param parts: The path of the directory within the cache.
+    :return: The path of the directory.
+    """
+    root = os.environ.get("CVBP_CACHE",
+                          os.path.join(os.path.expanduser("~"), ".cache", "cvbp"))
+    path = os.path.join(root, *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def batched(iterable, size):
+    """Group items into lists of at most size items, preserving order.
+
+    :param iterable: The items to group.
+    :param size: The maximum number of items in each list.
+    :return: A generator of lists.
+    """
+    items = iter(iterable)
+    batch = list(islice(items, size))
+    while batch:
+        yield batch
+        batch = list(islice(items, size))
+
+
+def prefetch(func, items, workers=0, depth=None):
+    """Apply a function to each item in a pool of worker threads.
+
+    The results are yielded in the order of the items while the workers
+    run ahead, so that image decoding overlaps with the inference the
+    caller does on each result. Image decoding and resizing release the
+    GIL so threads are sufficient to use all cores.
+
+    :param func: The function to apply, e.g. to decode an image.
+    :param items: The items to apply the function to.
+    :param workers: The number of worker threads, 0 to run inline.
+    :param depth: The most results to hold ahead of the caller
+                  (default is twice the number of workers).
+    :return: A generator of the results.
+    """
+    if workers < 1:
+        yield from map(func, items)
+        return
+
+    depth = max(depth or 2 * workers, 1)
+    with ThreadPoolExecutor(workers) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(func, item))
+            if len(pending) >= depth:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def background(iterable, depth=1):
+    """Iterate in a background thread, holding up to depth items ahead.
+
+    :param iterable: The items, e.g. from a generator decoding video.
+    :param depth: The most items to hold ahead of the caller.
+    :return: A generator of the same items.
+    """
+    done = object()
+    items = Queue(max(depth, 1))
+    errors = []
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put(item)
+        except Exception as e:
+            errors.append(e)  # Raised again by the caller.
+        finally:
+            items.put(done)
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item = items.get()
+        if item is done:
+            break
+        yield item
+    if errors:
+        raise errors[0]
+
+
+def _start_process(counter, threads):
+    """Pin a new worker process to its own threads and cores.
+    """
+    import torch
+
+    timing.take()  # Drop the parent's stages, copied by the fork.
+    with counter.get_lock():
+        index = counter.value
+        counter.value += 1
+    torch.set_num_threads(threads)
+    if hasattr(os, "sched_setaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+        mine = cores[index * threads:(index + 1) * threads]
+        if len(mine) == threads:
+            os.sched_setaffinity(0, mine)
+
+
+def _call(func, item):
+    """Apply a function in a worker, returning the stages it timed with it.
+    """
+    result = func(item)
+    return result, timing.take() if timing.enabled else None
+
+
+def fork_map(func, items, procs, depth=None):
+    """Apply a function to each item in a pool of forked processes.
+
+    As prefetch() but across processes, for work that is held back by
+    the GIL or does not scale across torch's threads. Anything loaded
+    before the call, such as the models, is shared copy-on-write with
+    the workers rather than loaded again. The cores are divided between
+    the workers, each pinned to its share. func must be defined at the
+    top level of a module, and is best given a batch of items per call.
+    The stages the workers time are merged into the parent's report.
+
+    :param func: The function to apply.
+    :param items: The items to apply the function to.
+    :param procs: The number of worker processes.
+    :param depth: The most results to hold ahead of the caller
+                  (default is twice the number of processes).
+    :return: A generator of the results, in the order of the items.
+    """
+    import multiprocessing
+
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") \
+        else os.cpu_count()
+    threads = max(cores // procs, 1)
+    context = multiprocessing.get_context("fork")
+    counter = context.Value("i", 0)
+
+    depth = max(depth or 2 * procs, 1)
+    with context.Pool(procs, _start_process, (counter, threads)) as pool:
+        pending = deque()
+
+        def collect():
+            result, taken = pending.popleft().get()
+            if taken is not None:
+                timing.merge(taken)
+            return result
+
+        for item in items:
+            pending.append(pool.apply_async(_call, (func, item)))
+            if len(pending) >= depth:
+                yield collect()
+        while pending:
+            yield collect()
+
+
+def is_video(path):
+    """Whether a path or url is a video file or stream.
+    """
+    parts = urlsplit(path)
+    return parts.scheme in STREAM_SCHEMES or \
+        os.path.splitext(parts.path)[1].lower() in VIDEO_EXTENSIONS
+
+
+def video_frames(source, every=1, fps=None):
+    """Sample frames from a video file or stream.
+
+    Frames that are skipped are grabbed but not decoded.
+
+    :param source: The video file or stream url.
+    :param every: Take every Nth frame.
+    :param fps: Instead take this many frames per second of video.
+    :return: A generator of (index, seconds, frame) with OpenCV frames.
+    """
+    capture = cv.VideoCapture(source)
+    if not capture.isOpened():
+        raise OSError(f"Unable to open the video '{source}'.")
+
+    rate = capture.get(cv.CAP_PROP_FPS) or 25
+    due = 0.0
+    index = 0
+    try:
+        while capture.grab():
+            seconds = index / rate
+            if fps:
+                take = seconds + 0.5 / rate >= due
+            else:
+                take = index % every == 0
+            if take:
+                ok, frame = capture.retrieve()
+                if ok:
+                    yield index, seconds, frame
+                if fps:
+                    due += 1 / fps
+            index += 1
+    finally:
+        capture.release()
+
+
 def cv2RGB(im_cv):
     """Convert OpenCV image's color from BGR to RGB.
     """
-
+    copies["cv2RGB"] += 1
     return cv.cvtColor(im_cv, cv.COLOR_BGR2RGB)
 
 
 def cv2matplotlib(im_cv):
     """Convert image from OpenCV format to matplotlib.
+
+    This is a view of the image with the channels reversed, without a
+    copy. matplotlib takes its own copy when drawing.
     """
 
-    return cv2RGB(im_cv)
+    return im_cv[:, :, ::-1]
 
 
 def cv2pil(im_cv):
     """Convert image from OpenCV format to PIL.
 
-    See https://stackoverflow.com/a/43234001
+    The BGR pixels are unpacked straight into an RGB image, a single copy.
+    """
+    height, width, _ = im_cv.shape
+    copies["cv2pil"] += 1
+    return PIL.Image.frombuffer("RGB", (width, height), np.ascontiguousarray(im_cv),
+                                "raw", "BGR", 0, 1)
+
+
+def frame_buffer(height, width, dtype=None):
+    """Allocate a tensor for cv2torch() to convert frames into, repeatedly.
+
+    The buffer is pinned when there is a GPU so that copying it to the
+    GPU need not wait.
+
+    :param dtype: The torch dtype, float32 by default.
     """
+    import torch
 
-    return PIL.Image.fromarray(cv2RGB(im_cv))
+    buffer = torch.empty((3, height, width), dtype=dtype or torch.float32)
+    return buffer.pin_memory() if torch.cuda.is_available() else buffer
 
 
-def cv2torch(im_cv):
+def cv2torch(im_cv, out=None, mean=None, std=None):
     """Convert image from OpenCV format to PyTorch tensor.
 
+    The flip from BGR to RGB, the transpose to channels first and the
+    conversion to floats in [0, 1] are done in a single copy, and the
+    scaling in a single pass over the result. The normalisation by mean
+    and std, if given, is folded into that same pass.
+
     See https://forums.fast.ai/t/prediction-on-video-input-file/41029/5
+
+    :param im_cv: The OpenCV image, height by width by BGR.
+    :param out: A tensor to reuse, from frame_buffer(). A uint8 tensor
+                receives the pixel values as they are.
+    :param mean: The mean of each RGB channel to normalise by.
+    :param std: The standard deviation of each RGB channel.
+    :return: The RGB tensor, channels by height by width.
     """
-    # Equivalent to:
-    #     torch.tensor(np.ascontiguousarray(np.flip(im_cv, 2)).transpose(2, 0, 1)).float() / 255
-    return T.Compose([T.ToTensor()])(cv2RGB(im_cv))
+    import torch
+
+    height, width, _ = im_cv.shape
+    if out is None:
+        out = torch.empty((3, height, width))
+
+    src = torch.from_numpy(im_cv)  # A view, not a copy.
+    for c in range(3):
+        out[c].copy_(src[:, :, 2 - c])
+    copies["cv2torch"] += 1
+    if out.dtype == torch.uint8:
+        return out
+
+    scale = torch.full((3, 1, 1), 1 / 255)
+    shift = torch.zeros((3, 1, 1))
+    if mean is not None:
+        mean = torch.tensor(mean).view(3, 1, 1)
+        std = torch.tensor(std).view(3, 1, 1)
+        scale, shift = scale / std, -mean / std
+    return torch.addcmul(shift, out, scale, out=out)
 
 
 def pil2matplotlib(im_pil):
     """Convert image from PIL format to matplotlib.
     """
-    return np.array(im_pil)
+    copies["pil2matplotlib"] += 1
+    return np.asarray(im_pil)
 
 
 def put_text(im_cv, text):
@@ -78,17 +345,171 @@ def put_text(im_cv, text):
     cv.putText(im_cv, text, (x, y), TEXT_FONT, TEXT_SIZE, TEXT_COLOR, LINE_WIDTH)
 
 
-def process_webcam(func, num):
+class FrameRate:
+    """Count events, such as frames, and report their rate.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.start = time.monotonic()
+
+    def tick(self):
+        self.count += 1
+
+    def fps(self):
+        return self.count / max(time.monotonic() - self.start, 1e-9)
+
+
+class Latest(threading.Condition):
+    """The latest frame and result shared between the pipeline threads.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.frame = None  # The newest frame not yet processed.
+        self.result = None  # The newest processed frame.
+        self.shown = True  # Whether the result has been displayed.
+        self.ended = False  # Whether the camera has no more frames.
+        self.done = False  # Whether processing has stopped.
+        self.error = None  # What stopped processing, raised by the caller.
+
+
+def capture_frames(camera, latest, stop, rates):
+    """Keep the latest frame from the camera, dropping any not yet used.
+
+    Video files are read at their own frame rate, as a camera would
+    deliver them, rather than as fast as they decode.
+    """
+    live = camera.get(cv.CAP_PROP_FRAME_COUNT) <= 0
+    delay = 0 if live else 1 / (camera.get(cv.CAP_PROP_FPS) or 25)
+    due = time.monotonic()
+
+    while not stop.is_set():
+        with timing.stage("capture"):
+            ok, frame = camera.read()
+        if not ok:
+            break
+        timing.count("frames_captured")
+        with latest:
+            if latest.frame is not None:
+                rates["dropped"].tick()
+                timing.count("frames_dropped")
+            latest.frame = frame
+            rates["capture"].tick()
+            latest.notify_all()
+        if delay:
+            due += delay
+            time.sleep(max(due - time.monotonic(), 0))
+
+    with latest:
+        latest.ended = True
+        latest.notify_all()
+
+
+def infer_frames(func, latest, stop, rates):
+    """Process the latest frame whenever the previous one is done.
+    """
+    try:
+        while not stop.is_set():
+            with latest:
+                while latest.frame is None and not latest.ended and not stop.is_set():
+                    latest.wait(0.1)
+                frame, latest.frame = latest.frame, None
+            if frame is None:
+                break
+
+            with timing.stage("webcam"):
+                result = func(frame)
+            with latest:
+                latest.result = result
+                latest.shown = False
+                rates["inference"].tick()
+                latest.notify_all()
+    except Exception as e:
+        latest.error = e  # Raised again by the caller.
+    finally:
+        with latest:
+            latest.done = True
+            latest.notify_all()
+
+
+def report_rates(rates):
+    """Return the measured rates as a line of text.
+    """
+    return ", ".join(f"{name} {rate.fps():.1f} fps" for name, rate in rates.items())
+
+
+def process_webcam(func, num, show=True, rates=None):
+    """Process frames from a camera in a pipeline of threads.
+
+    A capture thread always holds the latest frame from the camera, an
+    inference thread applies func to the latest frame whenever it is
+    free, dropping frames it can not keep up with, and the plot window
+    shows the most recent result. The measured rates are shown in the
+    window and reported on exit.
+
+    :param func: Processes an OpenCV frame, returning the image to show.
+    :param num: The camera number, or a video file or stream url.
+    :param show: Whether to show the results, or only process the frames
+                 until the video ends.
+    :param rates: Further FrameRate to show by name, ticked by func, such
+                  as the keyframes of a tracker.
+    :return: The measured rates, in frames per second.
+    """
+    if show:
+        import matplotlib.pyplot as plt
+        from matplotlib.animation import FuncAnimation
+
     camera = get_camera(num)  # Open webcam
-    plt.axis('off')  # Turn off axis in plot window
 
-#    print("\nPlease close the window (Ctrl-w) to quit.")
+    latest = Latest()
+    rates = {**{name: FrameRate() for name in ("capture", "inference", "display", "dropped")},
+             **(rates or {})}
+    stop = threading.Event()
+    threads = [
+        threading.Thread(target=capture_frames, args=(camera, latest, stop, rates), daemon=True),
+        threading.Thread(target=infer_frames, args=(func, latest, stop, rates), daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
 
-    im = plt.gca().imshow(func(camera))
-    video = FuncAnimation(
-        plt.gcf(),
-        lambda i: im.set_data(func(camera)),  # Update plot window with new camera frame
-        interval=100)
+    if show:
+        with latest:
+            while latest.result is None and not latest.done:
+                latest.wait(0.1)
 
-    plt.show()
+    if show and latest.result is not None:
+
+        def update(i):
+            with latest:
+                result, shown, latest.shown = latest.result, latest.shown, True
+                if latest.error is not None:
+                    plt.close()
+                    return
+            if not shown:
+                with timing.stage("display"):
+                    im.set_data(result)  # Update plot window with new result
+                rates["display"].tick()
+            plt.gca().set_title(report_rates(rates), fontsize=8)
+
+        plt.axis('off')  # Turn off axis in plot window
+
+        #    print("\nPlease close the window (Ctrl-w) to quit.")
+
+        im = plt.gca().imshow(latest.result)
+        video = FuncAnimation(plt.gcf(), update, interval=10)
+        plt.show()
+    else:
+        with latest:
+            while not latest.done:
+                latest.wait(0.1)
+
+    stop.set()
+    for thread in threads:
+        thread.join()
     camera.release()  # When everything is done, release the capture
+
+    sys.stderr.write(report_rates(rates) + "\n")
+    if latest.error is not None:
+        raise latest.error
+    return {name: rate.fps() for name, rate in rates.items()}
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# Author: Graham.Williams@microsoft.com
+#
+# A command line script to populate the local store of pre-trained
+# weights so that the other commands can run without the network, and
+# to compile the classifiers for faster CPU backends.
+#
+# ml weights cvbp [--model=<name>] [--verify] [--list]
+# ml weights cvbp --backend=<backend> [--model=<name>] [<path> ...]
+#
+# From the Microsoft Best Practices Suite: Computer Vision
+# https://github.com/microsoft/ComputerVision
+
+# ----------------------------------------------------------------------
+# Setup.
+# ----------------------------------------------------------------------
+
+# Required libraries.
+
+import os
+import sys
+import argparse
+
+from fastai.vision import open_image
+
+from fetch import locate, release
+from utils import batched
+from zoo import all_models, detectors, backends, weights_dir
+from zoo import read_manifest, write_manifest
+from zoo import store_weights, verify_weights, store_labels, LABELS
+from zoo import compile_model, agreement, prepare_image, image_batch
+
+# ----------------------------------------------------------------------
+# Parse command line arguments: path --model= --backend= --verify --list
+# ----------------------------------------------------------------------
+
+options = argparse.ArgumentParser(
+    prog='weights',
+    description='Store pre-trained weights locally.'
+)
+
+options.add_argument(
+    'path',
+    nargs="*",
+    help='images to calibrate int8 with and to compare backends on')
+
+options.add_argument(
+    '-m', '--model',
+    help="model to store (default is all)")
+
+options.add_argument(
+    '--backend',
+    choices=backends[1:],
+    help="also compile the classifiers for this backend")
+
+options.add_argument(
+    '--verify',
+    action='store_true',
+    help="check the stored weights against their checksums")
+
+options.add_argument(
+    '--list',
+    action='store_true',
+    help="list the stored weights")
+
+args = options.parse_args()
+
+known = all_models + detectors
+if args.backend is not None:
+    known = all_models  # Only classifiers compile.
+
+if args.model is None or args.model == "all":
+    modeln = known
+elif args.model in known:
+    modeln = [args.model]
+else:
+    sys.stderr.write(f"Selected model '{args.model}' is not known.\n")
+    sys.exit(1)
+
+# ----------------------------------------------------------------------
+# List, verify or populate the store.
+# ----------------------------------------------------------------------
+
+if args.list:
+    manifest = read_manifest()
+    for m in modeln:
+        if m in manifest:
+            print(f"{m},{manifest[m]['file']},{manifest[m]['size']}")
+    sys.exit(0)
+
+if args.verify:
+    failed = [m for m in modeln if not verify_weights(m)]
+    for m in failed:
+        sys.stderr.write(f"The stored weights for '{m}' are missing or corrupt.\n")
+    sys.exit(1 if failed else 0)
+
+if not os.path.exists(os.path.join(weights_dir(), LABELS)):
+    store_labels()
+
+for m in modeln:
+    if verify_weights(m):
+        continue
+    sys.stderr.write(f"Storing the weights for '{m}' in {weights_dir()}.\n")
+    store_weights(m)
+
+# ----------------------------------------------------------------------
+# Compile for a backend, comparing its top class with eager's.
+# ----------------------------------------------------------------------
+
+if args.backend is None:
+    sys.exit(0)
+
+ims = []
+for path, imfile in map(locate, args.path):
+    try:
+        ims.append(prepare_image(open_image(imfile, convert_mode='RGB')))
+    except:
+        sys.stderr.write(f"'{path}' may not be an image file and will be skipped.\n")
+    finally:
+        release(imfile)
+batches = [image_batch(xs) for xs in batched(ims, 16)]
+
+for m in modeln:
+    sys.stderr.write(f"Compiling '{m}' for {args.backend}.\n")
+    compile_model(m, args.backend, batches)
+    if not len(batches):
+        continue
+
+    agreed = agreement(m, args.backend, batches)
+    print(f"{agreed:.3f},{args.backend},{m}")
+    manifest = read_manifest()
+    manifest[f"{m}.{args.backend}"]["agreement"] = agreed
+    write_manifest(manifest)
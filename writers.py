@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# Author: Graham.Williams@microsoft.com
+#
+# Write the results of classify and detect as CSV, JSON lines, Parquet
+# or SQLite.
+#
+# Each command describes its results as columns, each a (name, type,
+# csv) where type is float, int or str and csv is the format of the
+# value in CSV, or None to leave it out of the CSV. Results are written
+# path by path as dicts of the column values, a value of None being left
+# out of the CSV so that videos add their frame and images do not.
+#
+# The results are streamed to disk: text as it comes, Parquet in part
+# files and SQLite in transactions of about ROWS rows. Each part or
+# transaction ends at a path and records the paths it completed, so
+# that an interrupted run resumes after the last path written, as
+# corpus.Checkpoint does for text.
+#
+# From the Microsoft Best Practices Suite: Computer Vision
+# https://github.com/microsoft/ComputerVision
+
+import json
+import os
+import sqlite3
+import sys
+
+formats = ["csv", "jsonl", "parquet", "sqlite"]
+
+ROWS = 10000  # Rows in each Parquet part and SQLite transaction.
+
+
+def plain(value):
+    """Return numpy scalars as the Python number, for JSON and SQLite."""
+    return value.item() if hasattr(value, "item") else value
+
+
+def csv_line(columns, row):
+    """Return a row as a line of CSV, as classify and detect have always written.
+    """
+    return ",".join(format(row[name], csv) for name, _, csv in columns
+                    if csv is not None and row.get(name) is not None) + "\n"
+
+
+def json_line(columns, row):
+    """Return a row as a line of JSON."""
+    return json.dumps({name: plain(row.get(name)) for name, _, _ in columns}) + "\n"
+
+
+class TextWriter:
+    """Write CSV or JSON lines to stdout or a checkpointed file.
+    """
+
+    def __init__(self, path, columns, line):
+        """
+        :param path: The file to write, or None for stdout.
+        :param line: Returns the text of a row, csv_line() or json_line().
+        """
+        import corpus
+
+        self.columns = columns
+        self.line = line
+        if path is None:
+            self.checkpoint, self.done = None, set()
+        else:
+            self.checkpoint = corpus.Checkpoint(path)
+            self.done = self.checkpoint.done
+
+    def write(self, path, rows):
+        """Write the rows for an image, or a frame of a video."""
+        text = "".join(self.line(self.columns, row) for row in rows)
+        if self.checkpoint is None:
+            sys.stdout.write(text)
+        else:
+            self.checkpoint.write(path, text)
+
+    def close(self):
+        if self.checkpoint is not None:
+            self.checkpoint.close()
+
+
+class BlockWriter:
+    """Gather the rows of completed paths into blocks of about ROWS.
+
+    A path is taken as complete when the rows of another follow, and is
+    recorded as done whether or not it had any rows, so that images with
+    no objects above --threshold are not processed again on resuming.
+    Subclasses write each block, with its done paths, as one whole.
+    """
+
+    def __init__(self, rows=ROWS):
+        self.rows = rows
+        self.current, self.finished, self.pending = None, [], []
+
+    def write(self, path, rows):
+        if path != self.current:
+            self._finish()
+            if len(self.pending) >= self.rows or len(self.finished) >= self.rows:
+                self.flush()
+            self.current = path
+        self.pending += rows
+
+    def _finish(self):
+        if self.current is not None:
+            self.finished.append(self.current)
+            self.current = None
+
+    def flush(self):
+        """Write the rows and paths completed so far as one block."""
+        if len(self.finished):
+            self.write_block(self.pending, self.finished)
+        self.finished, self.pending = [], []
+
+    def close(self):
+        self._finish()
+        self.flush()
+
+
+class SqliteWriter(BlockWriter):
+    """Write to a results table in SQLite, one transaction per block.
+
+    The completed paths are kept in a done table, committed with their
+    rows, and are skipped when resuming.
+    """
+
+    types = {"float": "REAL", "int": "INTEGER", "str": "TEXT"}
+
+    def __init__(self, path, columns, rows=ROWS):
+        from mlhub.utils import get_cmd_cwd
+
+        super().__init__(rows)
+        self.names = [name for name, _, _ in columns]
+        self.db = sqlite3.connect(os.path.join(get_cmd_cwd(), path), isolation_level=None)
+        self.db.execute("CREATE TABLE IF NOT EXISTS results (" +
+                        ", ".join(f"{name} {self.types[kind]}" for name, kind, _ in columns) +
+                        ")")
+        self.db.execute("CREATE TABLE IF NOT EXISTS done (path TEXT PRIMARY KEY)")
+        self.done = {p for p, in self.db.execute("SELECT path FROM done")}
+        self.insert = (f"INSERT INTO results ({', '.join(self.names)}) " +
+                       f"VALUES ({', '.join('?' * len(self.names))})")
+
+    def write_block(self, rows, paths):
+        self.db.execute("BEGIN")
+        self.db.executemany(self.insert, [tuple(plain(row.get(name)) for name in self.names)
+                                          for row in rows])
+        self.db.executemany("INSERT OR IGNORE INTO done VALUES (?)", [(p,) for p in paths])
+        self.db.execute("COMMIT")
+
+    def close(self):
+        super().close()
+        self.db.close()
+
+
+class ParquetWriter(BlockWriter):
+    """Write to a directory of Parquet files, one per block, with pyarrow.
+
+    pyarrow and pandas read the directory as one table. Each part is
+    written as .tmp and renamed once closed, so every part present is
+    whole, and records the paths it completed in its metadata. Resuming
+    adds new parts after them, with no need to read their rows.
+    """
+
+    def __init__(self, path, columns, rows=ROWS):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            sys.stderr.write("Writing Parquet needs pyarrow: pip install pyarrow\n")
+            sys.exit(1)
+        from mlhub.utils import get_cmd_cwd
+
+        super().__init__(rows)
+        self.pa, self.pq = pa, pq
+        types = {"float": pa.float64(), "int": pa.int64(), "str": pa.string()}
+        self.schema = pa.schema([(name, types[kind]) for name, kind, _ in columns])
+        self.directory = os.path.join(get_cmd_cwd(), path)
+        os.makedirs(self.directory, exist_ok=True)
+
+        parts = sorted(name for name in os.listdir(self.directory) if name.endswith(".parquet"))
+        self.done = set()
+        for name in parts:
+            meta = pq.read_schema(os.path.join(self.directory, name)).metadata or {}
+            self.done.update(json.loads(meta.get(b"done", b"[]")))
+        self.parts = len(parts)
+
+    def write_block(self, rows, paths):
+        columns = {name: [plain(row.get(name)) for row in rows] for name in self.schema.names}
+        schema = self.schema.with_metadata({"done": json.dumps(paths)})
+        part = os.path.join(self.directory, f"part-{self.parts:05d}.parquet")
+        self.pq.write_table(self.pa.table(columns, schema=schema), part + ".tmp")
+        os.replace(part + ".tmp", part)
+        self.parts += 1
+
+
+def open_writer(fmt, path, columns):
+    """Return the writer for a format, writing to path or stdout.
+
+    :param fmt: One of formats.
+    :param path: The file to write, or None for stdout as CSV or JSON lines.
+    :param columns: The (name, type, csv) of each column.
+    """
+    if fmt == "csv":
+        return TextWriter(path, columns, csv_line)
+    if fmt == "jsonl":
+        return TextWriter(path, columns, json_line)
+    if fmt == "sqlite":
+        return SqliteWriter(path, columns)
+    return ParquetWriter(path, columns)
@@ -0,0 +1,636 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# Author: Graham.Williams@microsoft.com
+#
+# The zoo of pre-built image classification models.
+#
+# From the Microsoft Best Practices Suite: Computer Vision
+# https://github.com/microsoft/ComputerVision
+
+import hashlib
+import importlib
+import json
+import os
+import re
+import sys
+import tempfile
+
+import cv2 as cv
+import torch
+import torchvision
+
+from functools import lru_cache
+
+from fastai.vision import models, normalize, imagenet_stats
+from fastai.vision import ImageDataBunch, Learner
+
+from utils_cv.classification.data import imagenet_labels
+from utils_cv.classification.model import IMAGENET_IM_SIZE
+from utils_cv.detection.model import _get_det_bboxes
+
+import timing
+
+from utils import cache_dir, copies, cv2torch
+
+# The names of the models, profiles and backends, kept apart so that
+# they can be listed without loading torch.
+
+from catalogue import all_models, detectors, profiles, backends
+
+# To be increased whenever the preprocessing or the form of the results
+# changes, so that results cached before are not reused.
+
+PREPROCESSING = 1
+
+# Other fastai models that were tried but can not be used here:
+#
+# BasicBlock, Darknet, ResLayer, ResNet, SqueezeNet, WideResNet, XResNet,
+# wrn_22, xception: unexpected keyword argument 'pretrained'
+# DynamicUnet: missing 2 required positional arguments: 'encoder' and 'n_classes'
+# UnetBlock: missing 3 required positional arguments: 'up_in_c', 'x_in_c', and 'hook'
+# darknet, unet, wrn, xresnet: 'module' object is not callable
+# xresnet18, xresnet34, xresnet50, xresnet101, xresnet152: name 'model_urls' is not defined
+
+
+# ----------------------------------------------------------------------
+# Local weight store
+# ----------------------------------------------------------------------
+
+# Pre-trained weights are kept in a local store so that models can be
+# built without the network. The store is populated once with `ml
+# weights cvbp` and records the url, size and SHA256 of each file in a
+# manifest. Weights are saved in the zip format so that torch can memory
+# map them, letting many processes share one copy in the page cache.
+
+MANIFEST = "manifest.json"
+LABELS = "imagenet_labels.json"
+
+
+def weights_dir():
+    """Return the directory of the weight store.
+
+    This is ~/.cache/cvbp/weights unless CVBP_WEIGHTS is set.
+    """
+    path = os.environ.get("CVBP_WEIGHTS") or cache_dir("weights")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def read_manifest():
+    """Return the manifest of the weight store, keyed by model name.
+    """
+    try:
+        with open(os.path.join(weights_dir(), MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def write_manifest(manifest):
+    fd, temp = tempfile.mkstemp(dir=weights_dir())
+    with os.fdopen(fd, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(temp, os.path.join(weights_dir(), MANIFEST))
+
+
+def weights_url(name):
+    """Return the url torchvision downloads a model's weights from.
+    """
+    try:
+        return torchvision.models.get_model_weights(name).DEFAULT.url
+    except AttributeError:
+        pass  # Older torchvision records the urls in each module.
+
+    build = getattr(torchvision.models, name, None) or \
+        getattr(torchvision.models.detection, name)
+    urls = sys.modules[build.__module__].model_urls
+    return urls.get(name) or urls[name + "_coco"]
+
+
+def sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def store_weights(name):
+    """Download a model's weights into the store and record them.
+
+    The download is checked against the hash in its file name, as
+    torchvision does, before being saved for memory mapping.
+
+    :param name: The name of the model, from all_models or detectors.
+    :return: The manifest entry for the model.
+    """
+    url = weights_url(name)
+    filename = os.path.basename(url)
+    hash_prefix = re.search(r"-([a-f0-9]*)\.", filename)
+
+    fd, temp = tempfile.mkstemp(dir=weights_dir())
+    os.close(fd)
+    try:
+        torch.hub.download_url_to_file(
+            url, temp, hash_prefix and hash_prefix.group(1), progress=False)
+        state = torch.load(temp, map_location="cpu")
+        torch.save(state, temp)
+        path = os.path.join(weights_dir(), filename)
+        os.replace(temp, path)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+
+    entry = {
+        "file": filename,
+        "url": url,
+        "size": os.path.getsize(path),
+        "sha256": sha256(path),
+    }
+    manifest = read_manifest()
+    manifest[name] = entry
+    write_manifest(manifest)
+    return entry
+
+
+def verify_weights(name):
+    """Check a model's stored weights against the manifest checksum.
+
+    :return: True if the weights are stored and intact.
+    """
+    entry = read_manifest().get(name)
+    if entry is None:
+        return False
+    path = os.path.join(weights_dir(), entry["file"])
+    return os.path.exists(path) and sha256(path) == entry["sha256"]
+
+
+def load_weights(name):
+    """Load a model's state dict from the store, memory mapped if possible.
+
+    :param name: The name of the model.
+    :return: The state dict, or None if the model is not in the store.
+    """
+    entry = read_manifest().get(name)
+    if entry is None:
+        return None
+
+    path = os.path.join(weights_dir(), entry["file"])
+    if not os.path.exists(path) or os.path.getsize(path) != entry["size"]:
+        raise OSError(f"The stored weights for '{name}' are missing or " +
+                      f"incomplete. Run: ml weights cvbp --model={name}")
+    try:
+        return torch.load(path, map_location="cpu", mmap=True)
+    except TypeError:
+        return torch.load(path, map_location="cpu")  # Before torch 2.1.
+
+
+def store_labels():
+    """Save the ImageNet labels into the store.
+    """
+    fd, temp = tempfile.mkstemp(dir=weights_dir())
+    with os.fdopen(fd, "w") as f:
+        json.dump(imagenet_labels(), f)
+    os.replace(temp, os.path.join(weights_dir(), LABELS))
+
+
+@lru_cache(maxsize=None)
+def imagenet_classes():
+    """Return the 1000 ImageNet labels, from the store if it has them.
+
+    Otherwise they are downloaded, which needs the network.
+    """
+    try:
+        with open(os.path.join(weights_dir(), LABELS)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return imagenet_labels()
+
+
+def fingerprint(name, *settings, backend=None):
+    """Identify the results of a model, for the result cache.
+
+    The fingerprint changes with the model's weights, the settings it
+    is run with, and PREPROCESSING. A classifier compiled for a backend
+    is identified by the compiled model, which must be in the store, so
+    that recompiling it, such as calibrating int8, changes the results.
+
+    :param name: The name of the model.
+    :param settings: Such as the detection profile.
+    :param backend: The backend of a classifier.
+    """
+    manifest = read_manifest()
+    if backend not in (None, "eager"):
+        weights = manifest[f"{name}.{backend}"]["sha256"]
+    else:
+        weights = manifest.get(name, {}).get("sha256")
+    weights = weights or f"torchvision-{torchvision.__version__}"
+    if backend is not None:
+        settings = (backend, *settings)
+    return ":".join([name, weights, *map(str, settings), f"v{PREPROCESSING}"])
+
+
+def pretrained(name, build, **kwargs):
+    """Build a pre-trained model, from the store if it has the weights.
+
+    Models not in the store fall back to torchvision's own download.
+
+    :param name: The name of the model.
+    :param build: The function building the model architecture.
+    :param kwargs: Further arguments for build.
+    :return: The model with its pre-trained weights.
+    """
+    with timing.stage("load"):
+        state = load_weights(name)
+        if state is None:
+            return build(pretrained=True, **kwargs)
+
+        model = build(pretrained=False, **kwargs)
+        model.load_state_dict(state)
+        return model
+
+# ----------------------------------------------------------------------
+# Model construction
+# ----------------------------------------------------------------------
+
+def build_learner(name):
+    """Build the fastai learner for one of the pre-built models.
+
+    :param name: The name of the model, one of all_models.
+    :return: The learner wrapping the pre-trained model.
+    """
+    if name not in all_models:
+        raise KeyError(f"Selected model '{name}' is not known.")
+
+    # As model_to_learner() but with the labels from the store. The
+    # empty DataBunch carries the resize and normalisation for predict().
+
+    empty_data = ImageDataBunch.single_from_classes(
+        "", classes=imagenet_classes(), size=IMAGENET_IM_SIZE
+    ).normalize(imagenet_stats)
+    return Learner(empty_data, pretrained(name, getattr(models, name)))
+
+
+def build_detector(name="fasterrcnn_resnet50_fpn", profile="realtime", **kwargs):
+    """Build one of the pre-built object detection models.
+
+    :param name: The name of the model, one of detectors.
+    :param profile: The name of the speed and accuracy profile.
+    :param kwargs: Settings for the model overriding the profile's.
+    :return: The pre-trained detection model.
+    """
+    if name not in detectors:
+        raise KeyError(f"Selected model '{name}' is not known.")
+    if profile not in profiles:
+        raise KeyError(f"Selected profile '{profile}' is not known.")
+
+    kwargs = {**profiles[profile], **kwargs}
+
+    build = getattr(torchvision.models.detection, name)
+    if name in read_manifest():
+        kwargs["pretrained_backbone"] = False  # Loaded with the rest.
+    return pretrained(name, build, **kwargs)
+
+
+def prepare_image(im):
+    """Resize an image to the size the models expect.
+
+    This is the same resize the learner applies to one image in predict()
+    and is safe to run in worker threads ahead of the forward pass.
+
+    :param im: The fastai image.
+    :return: The resized image tensor.
+    """
+    with timing.stage("preprocess"):
+        return im.apply_tfms(None, size=IMAGENET_IM_SIZE).data
+
+
+def prepare_frame(frame, out=None, normalise=True):
+    """Crop, resize and normalise an OpenCV frame for the models.
+
+    The centre square is resized while still 8 bit, and then converted
+    straight into a normalised tensor, so that only the small image is
+    ever held as floats.
+
+    :param frame: The OpenCV frame.
+    :param out: A tensor to reuse, from utils.frame_buffer().
+    :param normalise: Whether to normalise, or leave that to image_batch()
+                      as for prepare_image().
+    :return: The image tensor.
+    """
+    with timing.stage("preprocess"):
+        height, width, _ = frame.shape
+        side = min(height, width)
+        top, left = (height - side) // 2, (width - side) // 2
+        small = cv.resize(frame[top:top + side, left:left + side],
+                          (IMAGENET_IM_SIZE, IMAGENET_IM_SIZE),
+                          interpolation=cv.INTER_AREA)
+        copies["prepare_frame"] += 1
+        if not normalise:
+            return cv2torch(small, out)
+        mean, std = imagenet_stats
+        return cv2torch(small, out, mean, std)
+
+
+def image_batch(xs):
+    """Stack and normalise prepared images into a single batch tensor.
+    """
+    mean, std = map(torch.tensor, imagenet_stats)
+    return normalize(torch.stack(xs), mean, std)
+
+
+def predict_batch(model, xb):
+    """Return the class probabilities for a batch.
+
+    :param model: A learner, or a compiled model from get_model().
+    :param xb: The normalised batch from image_batch().
+    """
+    if isinstance(model, Learner):
+        xb = xb.to(model.data.device)
+        model = model.model.eval()
+    with torch.no_grad(), timing.forward():
+        return torch.softmax(model(xb), dim=1).cpu()
+
+
+def detect_batch(detector, ims, threshold=0.5):
+    """Detect the objects in a batch of images with one forward pass.
+
+    As DetectionLearner.predict() but for a list of images, which may be
+    of different sizes.
+
+    :param detector: The DetectionLearner.
+    :param ims: The PIL images.
+    :param threshold: The lowest score of the boxes to keep.
+    :return: The list of DetectionBbox found in each image.
+    """
+    device = next(detector.model.parameters()).device
+    xs = [torchvision.transforms.functional.to_tensor(im).to(device) for im in ims]
+    with torch.no_grad(), timing.forward():
+        preds = detector.model.eval()(xs)
+    return [[b for b in _get_det_bboxes([pred], labels=detector.labels)
+             if b.score > threshold] for pred in preds]
+
+# ----------------------------------------------------------------------
+# Embeddings
+# ----------------------------------------------------------------------
+
+# The classifiers without their last layer give the features of an
+# image, for similarity search. The resnets and densenets give their
+# pooled features, alexnet and the vggs the last hidden layer of their
+# classifier, and the squeezenets the pooled features of their trunk.
+
+
+def build_embedder(name):
+    """Build a pre-built model to return the features of its last layer.
+
+    :param name: The name of the model, one of all_models.
+    :return: The model, in evaluation mode.
+    """
+    if name not in all_models:
+        raise KeyError(f"Selected model '{name}' is not known.")
+
+    model = pretrained(name, getattr(models, name))
+    if hasattr(model, "fc"):
+        model.fc = torch.nn.Identity()
+    elif isinstance(model.classifier, torch.nn.Linear):
+        model.classifier = torch.nn.Identity()
+    elif name.startswith("squeezenet"):
+        model.classifier = torch.nn.AdaptiveAvgPool2d(1)
+    else:
+        model.classifier[-1] = torch.nn.Identity()
+    return model.eval()
+
+
+def embed_batch(model, xb):
+    """Return the L2 normalised features of a batch as a numpy array.
+
+    :param model: The model from build_embedder().
+    :param xb: The normalised batch from image_batch().
+    """
+    xb = xb.to(next(model.parameters()).device)
+    with torch.no_grad(), timing.forward():
+        features = model(xb).flatten(1)
+    return torch.nn.functional.normalize(features, dim=1).cpu().numpy()
+
+# ----------------------------------------------------------------------
+# Compiled CPU backends
+# ----------------------------------------------------------------------
+
+# As well as running the fastai learner eagerly, each classifier can be
+# compiled once into a TorchScript graph, an ONNX graph for ONNX Runtime,
+# or an int8 quantized TorchScript graph. The compiled files are kept in
+# the weight store and recorded in the manifest with the checksum of
+# the weights they were compiled from, so that they are compiled again
+# should the weights change.
+
+
+class OnnxModel:
+    """Run an ONNX graph with ONNX Runtime, called like a torch module.
+    """
+
+    def __init__(self, path):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError("The onnx backend needs: pip3 install onnxruntime")
+        self.session = onnxruntime.InferenceSession(
+            path, providers=["CPUExecutionProvider"])
+
+    def __call__(self, xb):
+        out, = self.session.run(None, {"input": xb.cpu().numpy()})
+        return torch.from_numpy(out)
+
+
+def quantize(model, example, batches=()):
+    """Quantize a model to int8.
+
+    With calibration batches the whole model is statically quantized
+    through torch.fx, otherwise only the linear layers are quantized,
+    dynamically.
+
+    :return: The quantized model and the kind of quantization.
+    """
+    quantization = torch.ao.quantization if hasattr(torch, "ao") else torch.quantization
+    if not len(batches):
+        return quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8), "dynamic"
+
+    quantize_fx = importlib.import_module(quantization.__name__ + ".quantize_fx")
+    try:
+        qconfig = quantization.get_default_qconfig_mapping("fbgemm")
+    except AttributeError:
+        qconfig = {"": quantization.get_default_qconfig("fbgemm")}  # Before torch 1.13.
+    try:
+        prepared = quantize_fx.prepare_fx(model, qconfig, (example,))
+    except TypeError:
+        prepared = quantize_fx.prepare_fx(model, qconfig)
+
+    for xb in batches:
+        prepared(xb)
+    return quantize_fx.convert_fx(prepared), "static"
+
+
+def save_script(model, example, path):
+    """Trace, freeze and save a model as TorchScript.
+    """
+    script = torch.jit.trace(model, example)
+    if hasattr(torch.jit, "freeze"):
+        script = torch.jit.freeze(script)
+    torch.jit.save(script, path)
+
+
+def compile_model(name, backend, batches=()):
+    """Compile a classifier for a backend into the weight store.
+
+    :param name: The name of the model, one of all_models.
+    :param backend: One of backends, other than eager.
+    :param batches: Normalised image batches to calibrate int8 with.
+    :return: The manifest entry for the compiled model.
+    """
+    if backend not in backends[1:]:
+        raise KeyError(f"Selected backend '{backend}' is not known.")
+
+    model = pretrained(name, getattr(models, name)).eval()
+    example = torch.zeros(1, 3, IMAGENET_IM_SIZE, IMAGENET_IM_SIZE)
+    filename = f"{name}.{backend}" + (".onnx" if backend == "onnx" else ".pt")
+    fd, temp = tempfile.mkstemp(dir=weights_dir())
+    os.close(fd)
+    entry = {"file": filename}
+
+    try:
+        with torch.no_grad():
+            if backend == "torchscript":
+                save_script(model, example, temp)
+            elif backend == "int8":
+                model, entry["quantization"] = quantize(model, example, batches)
+                save_script(model, example, temp)
+            else:
+                torch.onnx.export(model, example, temp,
+                                  input_names=["input"], output_names=["output"],
+                                  dynamic_axes={"input": {0: "batch"}, "output": {0: "batch"}},
+                                  opset_version=13)
+        path = os.path.join(weights_dir(), filename)
+        os.replace(temp, path)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+
+    manifest = read_manifest()
+    entry.update({
+        "size": os.path.getsize(path),
+        "sha256": sha256(path),
+        "source": manifest.get(name, {}).get("sha256"),
+    })
+    manifest[f"{name}.{backend}"] = entry
+    write_manifest(manifest)
+    return entry
+
+
+def compiled(name, backend):
+    """Return the entry of a compiled classifier, or None if it is missing or stale.
+    """
+    manifest = read_manifest()
+    entry = manifest.get(f"{name}.{backend}")
+    if entry is None or entry["source"] != manifest.get(name, {}).get("sha256"):
+        return None
+    if not os.path.exists(os.path.join(weights_dir(), entry["file"])):
+        return None
+    return entry
+
+
+def ensure_compiled(name, backend):
+    """Compile a classifier for a backend unless it is in the store.
+
+    :return: The manifest entry for the compiled model.
+    """
+    entry = compiled(name, backend)
+    if entry is None:
+        sys.stderr.write(f"Compiling '{name}' for {backend} into {weights_dir()}.\n")
+        entry = compile_model(name, backend)
+    return entry
+
+
+def load_compiled(name, backend):
+    """Load a compiled classifier, or None if it is missing or stale.
+    """
+    entry = compiled(name, backend)
+    if entry is None:
+        return None
+
+    path = os.path.join(weights_dir(), entry["file"])
+    if backend == "onnx":
+        return OnnxModel(path)
+    return torch.jit.load(path, map_location="cpu")
+
+
+def build_model(name, backend="eager"):
+    """Build a classifier to run on a backend.
+
+    Models not yet compiled for the backend are compiled first, which
+    for int8 quantizes only the linear layers. See `ml weights cvbp
+    --backend=int8` to calibrate a fully quantized model instead.
+
+    :param name: The name of the model, one of all_models.
+    :param backend: One of backends.
+    :return: The learner for eager, otherwise the compiled model.
+    """
+    if backend == "eager":
+        return build_learner(name)
+
+    ensure_compiled(name, backend)
+    with timing.stage("load"):
+        return load_compiled(name, backend)
+
+
+def agreement(name, backend, batches):
+    """Return how often a backend's top class agrees with eager's.
+
+    :param batches: Normalised image batches to compare on.
+    :return: The fraction of the images with the same top class.
+    """
+    learner, model = get_learner(name), get_model(name, backend)
+    same = total = 0
+    for xb in batches:
+        same += int((predict_batch(learner, xb).argmax(1) ==
+                     predict_batch(model, xb).argmax(1)).sum())
+        total += len(xb)
+    return same / max(total, 1)
+
+
+# Each model is built once per process and then reused. By default all
+# models are kept. See cache_learners() to bound this. The cache is
+# replaced rather than get_model() itself, so that the commands importing
+# get_model() by name see the bound.
+
+_models = lru_cache(maxsize=None)(build_model)
+
+
+def get_model(name, backend="eager"):
+    """Return the model for a backend, built once per process.
+    """
+    return _models(name, backend)
+
+
+def clear_models():
+    """Drop every model get_model() has kept.
+    """
+    _models.cache_clear()
+
+
+def get_learner(name):
+    """Return the learner for a model, built once per process.
+    """
+    return get_model(name, "eager")
+
+
+def cache_learners(size=None):
+    """Bound the number of models get_model() keeps in memory.
+
+    The least recently used model is dropped when the bound is
+    reached, so that --model=all need not hold every model at once.
+
+    :param size: The number of models to keep, or None for all.
+    """
+    global _models
+    _models = lru_cache(maxsize=size)(build_model)